@@ -1,19 +1,73 @@
+import array
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mmap
+import os
+import queue
 import random
-import copy
-
-
-# fixed addr
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# only used to draw random numbers in bulk for generate_commands()
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# fixed addr: two checkpoint regions, written in turn so an interrupted
+# checkpoint always leaves the previous one intact
 ADDR_CHECKPOINT_BLOCK = 0
+ADDR_CHECKPOINT_BLOCKS = (ADDR_CHECKPOINT_BLOCK, ADDR_CHECKPOINT_BLOCK + 1)
 
-# These are not (yet) things you can change
+# default geometry, every LFS can be given its own
 NUM_IMAP_PTRS_IN_CR = 8
 NUM_INODES_PER_IMAP_CHUNK = 8
 NUM_INODE_PTRS = 4
+# pointers in an indirect block; 0 leaves inodes with direct pointers only
+NUM_INDIRECT_PTRS = 0
+# imap chunk pointers in an imap index block; 0 keeps the imap single-level,
+# with the checkpoint region pointing at imap chunks directly
+NUM_IMAP_CHUNKS_PER_INDEX = 0
 
 NUM_INODES = NUM_IMAP_PTRS_IN_CR * NUM_INODES_PER_IMAP_CHUNK
 NUM_BLOCKS = NUM_INODES * NUM_INODE_PTRS
 
+# the log lives right after the checkpoint region, divided into segments
+ADDR_LOG_START = ADDR_CHECKPOINT_BLOCK + len(ADDR_CHECKPOINT_BLOCKS)
+SEGMENT_SIZE = 16
+NUM_SEGMENTS = NUM_BLOCKS // SEGMENT_SIZE
+
 GC_THRESHOLD = 0.8
+# incremental cleaning (if enabled) starts above this, well before GC_THRESHOLD
+CLEAN_LOW_WATERMARK = 0.7
+# cleaning picks enough victim segments to bring usage back down to this
+CLEAN_TARGET = 0.6
+
+# blocks held in the write buffer get provisional addresses starting here,
+# well past any real disk address, until a flush assigns them a place in the log
+ADDR_BUFFER_BASE = 1 << 40
+
+# imap entry of an inode number that is allocated but not logged yet
+ADDR_ALLOCATED = -2
+
+# segment summary index of indirect blocks: the single indirect block, the
+# double indirect block, and the indirect blocks under the double indirect
+# one (the k-th at SUMMARY_DOUBLE_INDIRECT_BASE - k)
+SUMMARY_INDIRECT = -2
+SUMMARY_DOUBLE_INDIRECT = -3
+SUMMARY_DOUBLE_INDIRECT_BASE = -4
 
 # block types
 BLOCK_TYPE_CHECKPOINT = "type_cp"
@@ -21,6 +75,46 @@ BLOCK_TYPE_DATA_DIRECTORY = "type_data_dir"
 BLOCK_TYPE_DATA_BLOCK = "type_data"
 BLOCK_TYPE_INODE = "type_inode"
 BLOCK_TYPE_IMAP = "type_imap"
+BLOCK_TYPE_INDIRECT = "type_indirect"
+BLOCK_TYPE_IMAP_INDEX = "type_imap_index"
+
+# disk image files: a header slot, a run of slots for each checkpoint region,
+# then one fixed-size slot per log block
+IMAGE_MAGIC = b"LFSIMAGE"
+IMAGE_BLOCK_SIZE = 4096
+IMAGE_HEADER = struct.Struct("<8sIQI")
+IMAGE_SUMMARY = struct.Struct("<qqqq")
+
+# checkpoints have room for a segment usage table this many times the size of
+# the nominal disk, in case the log outgrows it
+CHECKPOINT_HEADROOM = 2
+
+# binary traces: magic, then per command an operation code and a path number,
+# and for writes the offset and number of blocks; the first time a path is
+# used, TRACE_NEW_PATH is set in the code and its length and name follow
+TRACE_MAGIC = b"LFSTRACE"
+TRACE_RECORD = struct.Struct("<BI")
+TRACE_PATH_LENGTH = struct.Struct("<H")
+TRACE_WRITE_ARGS = struct.Struct("<IH")
+TRACE_NEW_PATH = 0x80
+TRACE_CODES = {"c": 1, "d": 2, "r": 3, "w": 4}
+TRACE_COMMANDS = {1: "c", 2: "d", 3: "r", 4: "w"}
+
+# what each command runs: the name of the method of LFS (and of its front
+# ends) taking the command's arguments
+COMMAND_METHODS = {
+    "c": "file_create",
+    "d": "dir_create",
+    "r": "file_delete",
+    "w": "file_write",
+}
+
+# default mix of commands for generated workloads: the range of a uniform
+# random number that picks each command
+COMMAND_MIX = {"c": (0.0, 0.3), "w": (0.3, 0.7), "d": (0.7, 0.9), "r": (0.9, 1.0)}
+
+# bytes of content hash a data block is found by in the dedup index
+FINGERPRINT_SIZE = 16
 
 # inode types
 INODE_DIRECTORY = "dir"
@@ -30,7 +124,468 @@ INODE_REGULAR = "reg"
 ROOT_INODE = 0
 
 # policies
-ALLOCATE_SEQUENTIAL = 1
+ALLOCATE_SEQUENTIAL = 1  # lowest free inode number first
+ALLOCATE_LOCALITY = 2  # free inode in the parent's imap chunk first
+
+CLEAN_COMPACT = 1  # stop-the-world compaction of the whole disk
+CLEAN_GREEDY = 2  # least utilized segments first
+CLEAN_COST_BENEFIT = 3  # highest (1 - u) * age / (1 + u) first
+
+# when dirty imap chunks and the checkpoint region are written out
+CHECKPOINT_EVERY_OP = 1  # after every operation (or write buffer flush)
+CHECKPOINT_OPS = 2  # every checkpoint_interval operations
+CHECKPOINT_BLOCKS = 3  # once checkpoint_interval blocks were logged since the last
+CHECKPOINT_SYNC = 4  # only on sync()
+
+# write streams, each filling its own segment
+STREAM_HOT = 0  # metadata, and data of files rewritten within hot_age operations
+STREAM_COLD = 1  # other data, and blocks the cleaner moves
+
+DIR_LINEAR = 1  # entries go in the first free slot of any dirblock
+DIR_HASHED = 2  # dirblocks are buckets of a linear hash table on the name
+
+# inode number of a directory entry removed from a DIR_HASHED directory that
+# can't split any further: lookups go on past it to the buckets that follow,
+# where names whose own bucket was full may have gone
+DIRENT_REMOVED = -2
+
+# which files generate_commands() writes to
+POPULARITY_UNIFORM = 1  # any existing file
+POPULARITY_ZIPF = 2  # the k-th oldest existing file with odds 1 / k ** zipf_s
+POPULARITY_HOT_COLD = 3  # hot_writes of the writes to the oldest hot_files
+
+
+#
+# Blocks: once logged a block is never changed in place, so a new version is
+# made with copy() (which only copies the pointer/entry list) and then updated
+#
+class Block:
+    __slots__ = ()
+    block_type = None
+
+    def copy(self):
+        new_block = object.__new__(type(self))
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, list):
+                value = list(value)
+            setattr(new_block, name, value)
+        return new_block
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return False
+        for name in self.__slots__:
+            if getattr(self, name) != getattr(other, name):
+                return False
+        return True
+
+
+class CheckpointBlock(Block):
+    __slots__ = (
+        "timestamp",
+        "entries",
+        "segment_live",
+        "segment_mtime",
+        "log_tail",
+        "cold_tail",
+        "serial",
+        "clock",
+        "end_timestamp",
+    )
+    block_type = BLOCK_TYPE_CHECKPOINT
+
+    def __init__(
+        self,
+        entries,
+        segment_live,
+        segment_mtime,
+        log_tail,
+        cold_tail,
+        serial,
+        clock,
+        timestamp,
+    ):
+        self.entries = entries
+        self.segment_live = segment_live
+        self.segment_mtime = segment_mtime
+        # where the log (and the cold write stream) stood when the checkpoint was taken
+        self.log_tail = log_tail
+        self.cold_tail = cold_tail
+        self.serial = serial
+        self.clock = clock
+        # written first and last: if they differ, writing it was interrupted
+        self.timestamp = timestamp
+        self.end_timestamp = timestamp
+
+
+class DirectoryBlock(Block):
+    __slots__ = ("entries",)
+    block_type = BLOCK_TYPE_DATA_DIRECTORY
+
+    def __init__(self, entries):
+        self.entries = entries
+
+
+class DataBlock(Block):
+    __slots__ = ("contents",)
+    block_type = BLOCK_TYPE_DATA_BLOCK
+
+    def __init__(self, contents):
+        self.contents = contents
+
+
+class Inode(Block):
+    __slots__ = ("type", "size", "refs", "pointers")
+    block_type = BLOCK_TYPE_INODE
+
+    def __init__(self, itype, size, refs, pointers):
+        self.type = itype
+        self.size = size
+        self.refs = refs
+        self.pointers = pointers
+
+
+class ImapChunk(Block):
+    __slots__ = ("entries",)
+    block_type = BLOCK_TYPE_IMAP
+
+    def __init__(self, entries):
+        self.entries = entries
+
+
+class IndirectBlock(Block):
+    __slots__ = ("pointers",)
+    block_type = BLOCK_TYPE_INDIRECT
+
+    def __init__(self, pointers):
+        self.pointers = pointers
+
+
+class ImapIndex(Block):
+    __slots__ = ("entries",)
+    block_type = BLOCK_TYPE_IMAP_INDEX
+
+    def __init__(self, entries):
+        self.entries = entries
+
+
+#
+# Binary encoding of blocks, used by the file-backed disk
+#
+BLOCK_CODE_CHECKPOINT = 1
+BLOCK_CODE_DATA_DIRECTORY = 2
+BLOCK_CODE_DATA_BLOCK = 3
+BLOCK_CODE_INODE = 4
+BLOCK_CODE_IMAP = 5
+BLOCK_CODE_INDIRECT = 6
+BLOCK_CODE_IMAP_INDEX = 7
+
+INODE_CODES = {INODE_DIRECTORY: 0, INODE_REGULAR: 1}
+INODE_TYPES = {0: INODE_DIRECTORY, 1: INODE_REGULAR}
+
+
+def pack_ints(values):
+    return struct.pack("<I%dq" % len(values), len(values), *values)
+
+
+def unpack_ints(data, offset):
+    (count,) = struct.unpack_from("<I", data, offset)
+    values = struct.unpack_from("<%dq" % count, data, offset + 4)
+    return list(values), offset + 4 + 8 * count
+
+
+def encode_block(block):
+    block_type = block.block_type
+    if block_type == BLOCK_TYPE_CHECKPOINT:
+        return (
+            bytes([BLOCK_CODE_CHECKPOINT])
+            + struct.pack("<q", block.timestamp)
+            + pack_ints(block.entries)
+            + pack_ints(block.segment_live)
+            + pack_ints(block.segment_mtime)
+            + struct.pack(
+                "<qqqq", block.log_tail, block.cold_tail, block.serial, block.clock
+            )
+            + struct.pack("<q", block.end_timestamp)
+        )
+    elif block_type == BLOCK_TYPE_DATA_DIRECTORY:
+        data = bytes([BLOCK_CODE_DATA_DIRECTORY]) + struct.pack(
+            "<I", len(block.entries)
+        )
+        for name, inum in block.entries:
+            name = name.encode()
+            data += struct.pack("<B", len(name)) + name + struct.pack("<q", inum)
+        return data
+    elif block_type == BLOCK_TYPE_DATA_BLOCK:
+        contents = block.contents.encode()
+        return (
+            bytes([BLOCK_CODE_DATA_BLOCK]) + struct.pack("<I", len(contents)) + contents
+        )
+    elif block_type == BLOCK_TYPE_INODE:
+        return (
+            bytes([BLOCK_CODE_INODE])
+            + struct.pack("<Bqq", INODE_CODES[block.type], block.size, block.refs)
+            + pack_ints(block.pointers)
+        )
+    elif block_type == BLOCK_TYPE_IMAP:
+        return bytes([BLOCK_CODE_IMAP]) + pack_ints(block.entries)
+    elif block_type == BLOCK_TYPE_INDIRECT:
+        return bytes([BLOCK_CODE_INDIRECT]) + pack_ints(block.pointers)
+    elif block_type == BLOCK_TYPE_IMAP_INDEX:
+        return bytes([BLOCK_CODE_IMAP_INDEX]) + pack_ints(block.entries)
+    raise ValueError("unknown block_type %s" % block_type)
+
+
+def decode_block(data):
+    code = data[0]
+    if code == BLOCK_CODE_CHECKPOINT:
+        (timestamp,) = struct.unpack_from("<q", data, 1)
+        entries, offset = unpack_ints(data, 9)
+        segment_live, offset = unpack_ints(data, offset)
+        segment_mtime, offset = unpack_ints(data, offset)
+        log_tail, cold_tail, serial, clock, end_timestamp = struct.unpack_from(
+            "<qqqqq", data, offset
+        )
+        checkpoint = CheckpointBlock(
+            entries,
+            segment_live,
+            segment_mtime,
+            log_tail,
+            cold_tail,
+            serial,
+            clock,
+            timestamp,
+        )
+        checkpoint.end_timestamp = end_timestamp
+        return checkpoint
+    elif code == BLOCK_CODE_DATA_DIRECTORY:
+        (count,) = struct.unpack_from("<I", data, 1)
+        offset = 5
+        entries = []
+        for i in range(count):
+            length = data[offset]
+            name = bytes(data[offset + 1 : offset + 1 + length]).decode()
+            (inum,) = struct.unpack_from("<q", data, offset + 1 + length)
+            entries.append((name, inum))
+            offset += 1 + length + 8
+        return DirectoryBlock(entries)
+    elif code == BLOCK_CODE_DATA_BLOCK:
+        (length,) = struct.unpack_from("<I", data, 1)
+        return DataBlock(bytes(data[5 : 5 + length]).decode())
+    elif code == BLOCK_CODE_INODE:
+        itype, size, refs = struct.unpack_from("<Bqq", data, 1)
+        pointers, offset = unpack_ints(data, 18)
+        return Inode(INODE_TYPES[itype], size, refs, pointers)
+    elif code == BLOCK_CODE_IMAP:
+        entries, offset = unpack_ints(data, 1)
+        return ImapChunk(entries)
+    elif code == BLOCK_CODE_INDIRECT:
+        pointers, offset = unpack_ints(data, 1)
+        return IndirectBlock(pointers)
+    elif code == BLOCK_CODE_IMAP_INDEX:
+        entries, offset = unpack_ints(data, 1)
+        return ImapIndex(entries)
+    raise ValueError("unknown block code %d" % code)
+
+
+#
+# Disks hold blocks plus, for every block, its segment summary entry:
+# (serial, mtime, inum, index) where serial is the log sequence number of the
+# write, mtime the logical time, and (inum, index) the owner -- the pointer
+# index within the inode for data/dir blocks (the file block number), one of
+# the SUMMARY_* values for indirect blocks, -1 for inodes, imap chunks and
+# imap index blocks (whose inum field holds the chunk or index block number)
+#
+class MemoryDisk:
+    def __init__(self):
+        self.blocks = []
+        self.summaries = []
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, address):
+        return self.blocks[address]
+
+    def summary(self, address):
+        return self.summaries[address]
+
+    def write(self, address, block, summary):
+        if address == len(self.blocks):
+            self.blocks.append(block)
+            self.summaries.append(summary)
+        else:
+            self.blocks[address] = block
+            self.summaries[address] = summary
+        return
+
+    def truncate(self, num_blocks):
+        del self.blocks[num_blocks:]
+        del self.summaries[num_blocks:]
+        return
+
+    def format(self, checkpoint_size, block_size):
+        self.truncate(0)
+        return
+
+    def sync(self):
+        return
+
+
+# File-backed disk: every block (with its summary entry in front) lives in a
+# fixed-size slot of an image file, accessed through mmap; a checkpoint region
+# (which grows with the segment usage table) gets a run of checkpoint_slots
+class MmapDisk:
+    def __init__(self, path, block_size=IMAGE_BLOCK_SIZE):
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # reopen an existing image
+            self.file = open(path, "r+b")
+            magic, self.block_size, self.num_blocks, self.checkpoint_slots = (
+                IMAGE_HEADER.unpack(self.file.read(IMAGE_HEADER.size))
+            )
+            if magic != IMAGE_MAGIC:
+                raise ValueError("%s is not a disk image" % path)
+        else:
+            self.file = open(path, "w+b")
+            self.block_size = block_size
+            self.num_blocks = 0
+            self.checkpoint_slots = 1
+            self.file.truncate(self.block_size * 16)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.__write_header()
+
+    def __write_header(self):
+        IMAGE_HEADER.pack_into(
+            self.mm,
+            0,
+            IMAGE_MAGIC,
+            self.block_size,
+            self.num_blocks,
+            self.checkpoint_slots,
+        )
+        return
+
+    def __slot(self, address):
+        # slot 0 of the file holds the header, then come the checkpoint regions
+        if address < 0 or address >= self.num_blocks:
+            raise IndexError("disk address %d out of range" % address)
+        if address < ADDR_LOG_START:
+            return (1 + address * self.checkpoint_slots) * self.block_size
+        return (
+            1 + ADDR_LOG_START * (self.checkpoint_slots - 1) + address
+        ) * self.block_size
+
+    def __room(self, address):
+        # bytes available at an address, summary entry included
+        if address < ADDR_LOG_START:
+            return self.checkpoint_slots * self.block_size
+        return self.block_size
+
+    def __len__(self):
+        return self.num_blocks
+
+    def __getitem__(self, address):
+        start = self.__slot(address)
+        return decode_block(
+            memoryview(self.mm)[
+                start + IMAGE_SUMMARY.size : start + self.__room(address)
+            ]
+        )
+
+    def summary(self, address):
+        return IMAGE_SUMMARY.unpack_from(self.mm, self.__slot(address))
+
+    def write(self, address, block, summary):
+        if address == self.num_blocks:
+            self.num_blocks += 1
+            while self.__slot(address) + self.__room(address) > len(self.mm):
+                # out of room in the file: double it
+                self.mm.resize(len(self.mm) * 2)
+            self.__write_header()
+        data = IMAGE_SUMMARY.pack(*summary) + encode_block(block)
+        if len(data) > self.__room(address):
+            raise ValueError(
+                "%s needs %d bytes, more than the %d bytes at address %d"
+                % (block.block_type, len(data), self.__room(address), address)
+            )
+        start = self.__slot(address)
+        self.mm[start : start + len(data)] = data
+        return
+
+    def format(self, checkpoint_size, block_size):
+        # start over, for a file system whose checkpoints take up to
+        # checkpoint_size bytes and its other metadata up to block_size bytes
+        if IMAGE_SUMMARY.size + block_size > self.block_size:
+            raise ValueError(
+                "geometry needs blocks of %d bytes, more than the %d byte block size"
+                % (IMAGE_SUMMARY.size + block_size, self.block_size)
+            )
+        self.num_blocks = 0
+        self.checkpoint_slots = -(
+            -(IMAGE_SUMMARY.size + checkpoint_size) // self.block_size
+        )
+        self.__write_header()
+        return
+
+    def truncate(self, num_blocks):
+        self.num_blocks = min(self.num_blocks, num_blocks)
+        self.__write_header()
+        return
+
+    def sync(self):
+        self.mm.flush()
+        return
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+        return
+
+
+#
+# Size-bounded cache with least-recently-used eviction
+#
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.size == 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+        return
+
+    def clear(self):
+        self.entries.clear()
+        return
+
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0
+        return self.hits / (self.hits + self.misses)
 
 
 #
@@ -42,7 +597,56 @@ class LFS:
         use_disk_cr=False,
         no_force_checkpoints=False,
         inode_policy=ALLOCATE_SEQUENTIAL,
+        *,
+        checkpoint_policy=CHECKPOINT_EVERY_OP,
+        checkpoint_interval=0,
+        write_buffer_size=0,
+        clean_policy=CLEAN_COST_BENEFIT,
+        disk=None,
+        mount=False,
+        inode_cache_size=0,
+        imap_cache_size=0,
+        read_cache_size=0,
+        readahead=0,
+        num_imap_ptrs_in_cr=NUM_IMAP_PTRS_IN_CR,
+        num_inodes_per_imap_chunk=NUM_INODES_PER_IMAP_CHUNK,
+        num_inode_ptrs=NUM_INODE_PTRS,
+        num_indirect_ptrs=NUM_INDIRECT_PTRS,
+        num_imap_chunks_per_index=NUM_IMAP_CHUNKS_PER_INDEX,
+        num_blocks=None,
+        dir_layout=DIR_LINEAR,
+        hot_age=0,
+        clean_budget=0,
+        gc_threshold=GC_THRESHOLD,
+        instrument=False,
+        rng=None,
+        dedup=False,
     ):
+        # geometry: with a two-level imap the checkpoint region points at imap
+        # index blocks, each pointing at num_imap_chunks_per_index imap chunks
+        self.num_imap_ptrs_in_cr = num_imap_ptrs_in_cr
+        self.num_imap_chunks_per_index = num_imap_chunks_per_index
+        self.num_imap_chunks = num_imap_ptrs_in_cr * max(1, num_imap_chunks_per_index)
+        self.num_inodes_per_imap_chunk = num_inodes_per_imap_chunk
+        self.num_inodes = self.num_imap_chunks * num_inodes_per_imap_chunk
+
+        # inodes have num_inode_ptrs direct pointers, followed by a single and
+        # a double indirect pointer if indirect blocks are used
+        self.num_inode_ptrs = num_inode_ptrs
+        self.num_indirect_ptrs = num_indirect_ptrs
+        self.num_pointers = num_inode_ptrs
+        if num_indirect_ptrs:
+            self.num_pointers += 2
+        self.max_file_blocks = (
+            num_inode_ptrs + num_indirect_ptrs + num_indirect_ptrs * num_indirect_ptrs
+        )
+
+        # nominal disk size, which cleaning thresholds are relative to
+        if num_blocks is None:
+            num_blocks = self.num_inodes * num_inode_ptrs
+        self.num_blocks = num_blocks
+        self.num_segments = num_blocks // SEGMENT_SIZE
+
         # whether to read checkpoint region and imap pieces from disk (if True)
         # or instead just to use "in-memory" inode map instead
         self.use_disk_cr = use_disk_cr
@@ -50,177 +654,998 @@ class LFS:
         # to force an update of the checkpoint region after each write
         self.no_force_checkpoints = no_force_checkpoints
 
-        # inode allocation policy
+        # when to take checkpoints; with anything but CHECKPOINT_EVERY_OP
+        # dirty imap chunks are also held back until the next checkpoint
+        self.checkpoint_policy = checkpoint_policy
+        self.checkpoint_interval = checkpoint_interval
+
+        # the latest checkpoint: which region it is in, its timestamp (number
+        # of checkpoints taken), and the log serial and clock it was taken at
+        self.checkpoint_address = ADDR_CHECKPOINT_BLOCK
+        self.checkpoint_timestamp = 0
+        self.checkpoint_serial = 0
+        self.checkpoint_clock = 0
+
+        # inode allocation policy, a bitmap of free inodes per imap chunk (bit i
+        # set means inode i of the chunk is free), and a heap of the chunks
+        # queued as having free inodes (some may have filled up since)
         self.inode_policy = inode_policy
+        self.free_inodes = []
+        self.free_chunks = []
+        self.free_chunk_queued = bytearray()
+
+        # write buffering: operations are absorbed in memory and flushed to the
+        # log as one batch once this many blocks are pending (0 disables it)
+        self.write_buffer_size = write_buffer_size
+        self.buffer = []
+        # inode number -> inode address before it was first touched in the buffer
+        self.buffer_imap_base = {}
+        # imap chunks changed since the last time they were logged
+        self.dirty_chunks = set()
+        # nesting depth of group_commit(); inside it operations leave the imap
+        # and checkpoint to the end of the group
+        self.group_depth = 0
+
+        # how to reclaim space once gc_threshold (of num_blocks) is crossed
+        self.clean_policy = clean_policy
+        self.gc_threshold = gc_threshold
+
+        # incremental cleaning: above CLEAN_LOW_WATERMARK every operation
+        # cleans segments with up to clean_budget live blocks in them, and only
+        # above gc_threshold does it block on a full clean (0 turns it off)
+        self.clean_budget = clean_budget
+        self.clean_steps = 0
+        self.clean_step_written = 0
+
+        # number of garbage collections run so far, and blocks ever logged
+        # (also by block type)
+        self.gc_count = 0
+        self.blocks_written = 0
+        self.blocks_by_type = {}
+
+        # cumulative cleaning cost: segments cleaned, blocks read/written/freed,
+        # and live blocks copied (by the cleaner or gc())
+        self.clean_stats = {
+            "segments": 0,
+            "read": 0,
+            "written": 0,
+            "freed": 0,
+            "moved": 0,
+        }
+
+        # logical clock, ticks once per file operation
+        self.clock = 0
+
+        # segment usage table: live blocks and youngest write time per segment
+        self.segment_live = [0] * self.num_segments
+        self.segment_mtime = [0] * self.num_segments
+
+        # liveness of every block on disk, kept up to date as blocks are
+        # logged and superseded
+        self.live = bytearray()
+
+        # segments freed by the cleaner, ready to be written again
+        self.clean_segments = set()
+
+        # next address the log writes to, and the cold write stream (-1 when
+        # it has no segment open)
+        self.log_tail = ADDR_LOG_START
+        self.cold_tail = -1
+
+        # hot/cold separation: a file written again within hot_age operations
+        # is hot (0 puts everything in one stream); inode number -> last write
+        self.hot_age = hot_age
+        self.last_write = {}
+        self.hot_files = set()
+
+        # dump assistance: addresses logged since the last partial dump, kept
+        # only once something has been dumped (None until then)
+        self.dump_pending = None
+
+        # blocks recovered by roll-forward when mounting
+        self.rolled_forward = 0
+
+        # LRU caches of inodes (by inode number) and imap pieces (by chunk
+        # number) read from disk; a size of 0 turns a cache off
+        self.inode_cache = LRUCache(inode_cache_size)
+        self.imap_cache = LRUCache(imap_cache_size)
+
+        # file_read(): LRU cache of blocks by address, and how many blocks
+        # following a missed one in the same segment come in with it
+        self.read_cache = LRUCache(read_cache_size)
+        self.readahead = readahead
+        # blocks read, disk fetches (readahead included in the fetch that
+        # triggered it), and log distance summed over consecutive file blocks
+        self.read_stats = {"blocks": 0, "fetches": 0, "distance": 0, "pairs": 0}
+
+        # how names are laid out in directory blocks, and (for DIR_LINEAR) the
+        # first dirblock of each directory that may have a free slot
+        self.dir_layout = dir_layout
+        self.dir_free_hint = {}
+
+        # dentry cache: (parent inode number, name) -> inode number
+        self.dentry_cache = {}
+        self.dentry_hits = 0
+        self.dentry_misses = 0
+        self.dirblocks_read = 0
+        self.path_lookups = 0
+
+        # instrumentation, off by default: event counts and other counters,
+        # seconds spent per event, and hooks called with every event
+        self.instrument = instrument
+        self.counters = {}
+        self.timers = {}
+        self.hooks = []
+
+        # deduplication of data blocks: content hash -> address of a live data
+        # block with that content, and address -> the (inode number, block
+        # number) of every file block pointing at it; a block stays live as
+        # long as one of those is left, and writes of contents already on
+        # disk point at the existing block instead of logging another
+        self.dedup = dedup
+        self.fingerprints = {}
+        self.block_refs = {}
+        self.dedup_hits = 0
+
+        # ALL blocks are in the "disk": in memory, or e.g. an MmapDisk
+        if disk is None:
+            disk = MemoryDisk()
+        self.disk = disk
+
+        # random numbers for block contents: the module's shared stream, or
+        # e.g. a random.Random of its own
+        self.rng = random if rng is None else rng
 
-        # dump assistance
-        self.dump_last = 1
+        # error code: tracking
+        self.error_clear()
+
+        # either pick up the file system already on the disk, or format it
+        if mount:
+            self.__mount()
+        else:
+            self.__format()
+        return
 
-        # ALL blocks are in the "disk"
-        self.disk = []
+    def __format(self):
+        # the disk makes room for the largest blocks of this geometry up front
+        self.disk.format(*self.__max_block_sizes())
 
-        # checkpoint region (first block)
-        self.cr = [-1] * NUM_IMAP_PTRS_IN_CR
-        self.cr[0] = 3
-        assert len(self.cr) == NUM_IMAP_PTRS_IN_CR
+        # in memory imap chunk (and imap index block) addresses
+        self.cr = [-1] * self.num_imap_chunks
+        self.imap_index = []
+        if self.num_imap_chunks_per_index:
+            self.imap_index = [-1] * self.num_imap_ptrs_in_cr
 
-        # create first checkpoint region
-        self.log({"block_type": BLOCK_TYPE_CHECKPOINT, "entries": self.cr})
-        assert len(self.disk) == 1
+        # checkpoint regions (first blocks), filled in once the root is there
+        for address in ADDR_CHECKPOINT_BLOCKS:
+            self.disk.write(address, self.make_checkpoint(), (-1, 0, -1, -1))
+            self.live.append(1)
+        assert len(self.disk) == ADDR_LOG_START
 
         # init root dir data
-        self.log(self.make_new_dirblock(ROOT_INODE, ROOT_INODE))
-        assert len(self.disk) == 2
+        root_dirblock_address = self.__append(
+            self.make_new_dirblock(ROOT_INODE, ROOT_INODE), (ROOT_INODE, 0)
+        )
 
         # root inode
         root_inode = self.make_inode(itype=INODE_DIRECTORY, size=1, refs=2)
-        root_inode["pointers"][0] = 1
-        root_inode_address = self.log(root_inode)
-        assert len(self.disk) == 3
+        root_inode.pointers[0] = root_dirblock_address
+        root_inode_address = self.__append(root_inode, (ROOT_INODE, -1))
 
         # init in memory imap
         self.inode_map = {}
-        for i in range(NUM_INODES):
+        for i in range(self.num_inodes):
             self.inode_map[i] = -1
         self.inode_map[ROOT_INODE] = root_inode_address
+        self.__build_free_inodes()
 
-        # imap piece
-        self.log(self.make_imap_chunk(ROOT_INODE))
-        assert len(self.disk) == 4
+        # imap piece (and the index block pointing at it), then the checkpoint
+        self.dirty_chunks.add(self.inum_to_chunk(ROOT_INODE))
+        self.cr_sync()
+        return
 
-        # error code: tracking
-        self.error_clear()
+    def __mount(self):
+        # checkpoint region: imap pieces, segment usage and where the log stood
+        checkpoint = self.__latest_checkpoint()
+        assert len(checkpoint.entries) == self.num_imap_ptrs_in_cr
+        self.checkpoint_timestamp = checkpoint.timestamp
+        self.checkpoint_serial = checkpoint.serial
+        self.checkpoint_clock = checkpoint.clock
+        self.segment_live = list(checkpoint.segment_live)
+        self.segment_mtime = list(checkpoint.segment_mtime)
+        self.log_tail = checkpoint.log_tail
+        self.cold_tail = checkpoint.cold_tail
+        self.blocks_written = checkpoint.serial
+        self.clock = checkpoint.clock
+
+        # imap chunk addresses, from the index blocks with a two-level imap
+        self.imap_index = []
+        if self.num_imap_chunks_per_index:
+            self.cr = [-1] * self.num_imap_chunks
+            self.imap_index = list(checkpoint.entries)
+            for i in range(len(self.imap_index)):
+                if self.imap_index[i] != -1:
+                    self.__load_imap_index(i, self.disk[self.imap_index[i]])
+        else:
+            self.cr = list(checkpoint.entries)
+
+        # rebuild the in memory imap from the pieces
+        self.inode_map = {}
+        for i in range(self.num_inodes):
+            self.inode_map[i] = -1
+        for cnum in range(self.num_imap_chunks):
+            if self.cr[cnum] != -1:
+                self.__load_imap_chunk(cnum, self.disk[self.cr[cnum]])
+
+        # roll forward: replay inodes and imap pieces logged after the checkpoint
+        for address in self.__log_after_checkpoint(checkpoint.serial):
+            serial, mtime, inum, index = self.disk.summary(address)
+            block = self.disk[address]
+            if block.block_type == BLOCK_TYPE_INODE:
+                # the next checkpoint has to cover it, or it is lost again
+                self.inode_map[inum] = address
+                self.dirty_chunks.add(self.inum_to_chunk(inum))
+            elif block.block_type == BLOCK_TYPE_IMAP:
+                self.cr[inum] = address
+                self.__load_imap_chunk(inum, block)
+            elif block.block_type == BLOCK_TYPE_IMAP_INDEX:
+                self.imap_index[inum] = address
+                self.__load_imap_index(inum, block)
+            self.log_tail = address + 1
+            self.blocks_written = serial + 1
+            self.clock = max(self.clock, mtime)
+            self.rolled_forward += 1
+
+        # a delete leaves nothing to roll forward but a new version of the
+        # directory without the entry: inodes it can't reach are free again
+        if self.rolled_forward:
+            self.__free_unreachable_inodes()
+
+        self.__build_free_inodes()
+
+        # the cold stream starts over in a new segment
+        self.cold_tail = -1
+
+        # liveness isn't kept on disk, so work it out again; segments with
+        # nothing live in them can be written right away
+        self.determine_liveness()
+        if self.rolled_forward:
+            # the old checkpoint points into the log that was rolled forward,
+            # which may be in those segments: checkpoint before reusing them
+            self.cr_sync()
+        tail_segment = self.address_to_segment(self.log_tail - 1)
+        for snum in range(len(self.segment_live)):
+            if (
+                self.segment_live[snum] == 0
+                and snum != tail_segment
+                and len(self.segment_addresses(snum)) == SEGMENT_SIZE
+            ):
+                self.clean_segments.add(snum)
+                self.segment_mtime[snum] = 0
+        return
+
+    def __latest_checkpoint(self):
+        # the newer of the two checkpoint regions, skipping one whose write
+        # was interrupted (timestamps don't match, or it can't be read at all)
+        latest = None
+        for address in ADDR_CHECKPOINT_BLOCKS:
+            try:
+                checkpoint = self.disk[address]
+            except (ValueError, IndexError, struct.error):
+                continue
+            if checkpoint.block_type != BLOCK_TYPE_CHECKPOINT:
+                continue
+            if checkpoint.timestamp != checkpoint.end_timestamp:
+                continue
+            if latest is None or checkpoint.timestamp > latest.timestamp:
+                latest = checkpoint
+                self.checkpoint_address = address
+        assert latest is not None, "no valid checkpoint region"
+        return latest
+
+    def __free_unreachable_inodes(self):
+        # walk the directory tree from the root
+        reachable = {ROOT_INODE}
+        directories = [ROOT_INODE]
+        while directories:
+            inode = self.disk[self.inode_map[directories.pop()]]
+            for index in range(inode.size):
+                address = self.bmap(inode, index)
+                if address == -1:
+                    continue
+                for name, inum in self.disk[address].entries:
+                    if name == "." or name == ".." or inum in reachable:
+                        continue
+                    if inum < 0 or self.inode_map[inum] < 0:
+                        continue
+                    reachable.add(inum)
+                    if self.disk[self.inode_map[inum]].type == INODE_DIRECTORY:
+                        directories.append(inum)
+        for inum in range(self.num_inodes):
+            if self.inode_map[inum] != -1 and inum not in reachable:
+                self.inode_map[inum] = -1
+                self.dirty_chunks.add(self.inum_to_chunk(inum))
         return
 
+    def __build_free_inodes(self):
+        n = self.num_inodes_per_imap_chunk
+        self.free_inodes = [0] * self.num_imap_chunks
+        for i in range(self.num_inodes):
+            if self.inode_map[i] == -1:
+                self.free_inodes[i // n] |= 1 << (i % n)
+        # in order, so already a heap
+        self.free_chunks = [
+            cnum for cnum in range(self.num_imap_chunks) if self.free_inodes[cnum]
+        ]
+        self.free_chunk_queued = bytearray(self.num_imap_chunks)
+        for cnum in self.free_chunks:
+            self.free_chunk_queued[cnum] = 1
+        return
+
+    def __load_imap_chunk(self, cnum, imap_chunk):
+        assert imap_chunk.block_type == BLOCK_TYPE_IMAP
+        start = cnum * self.num_inodes_per_imap_chunk
+        for i in range(self.num_inodes_per_imap_chunk):
+            self.inode_map[start + i] = imap_chunk.entries[i]
+        return
+
+    def __load_imap_index(self, index, imap_index):
+        assert imap_index.block_type == BLOCK_TYPE_IMAP_INDEX
+        start = index * self.num_imap_chunks_per_index
+        self.cr[start : start + self.num_imap_chunks_per_index] = imap_index.entries
+        return
+
+    def __log_after_checkpoint(self, serial):
+        # the log continues in the segment the checkpoint left off in, and then
+        # moves on to other segments, each starting with a newer block
+        segments = set()
+        for tail in (self.log_tail, self.cold_tail):
+            if tail != -1 and tail < len(self.disk):
+                segments.add(self.address_to_segment(tail))
+        for snum in range(self.address_to_segment(len(self.disk) - 1) + 1):
+            if self.disk.summary(ADDR_LOG_START + snum * SEGMENT_SIZE)[0] >= serial:
+                segments.add(snum)
+        addresses = []
+        for snum in segments:
+            for address in self.segment_addresses(snum):
+                if self.disk.summary(address)[0] >= serial:
+                    addresses.append(address)
+        addresses.sort(key=lambda address: self.disk.summary(address)[0])
+        return addresses
+
+    def make_checkpoint(self):
+        # with a two-level imap only the index blocks are in the checkpoint
+        if self.num_imap_chunks_per_index:
+            entries = list(self.imap_index)
+        else:
+            entries = list(self.cr)
+        return CheckpointBlock(
+            entries,
+            list(self.segment_live),
+            list(self.segment_mtime),
+            self.log_tail,
+            self.cold_tail,
+            self.blocks_written,
+            self.clock,
+            self.checkpoint_timestamp,
+        )
+
+    def __max_block_sizes(self):
+        # encoded size of the largest checkpoint (with its segment usage table
+        # CHECKPOINT_HEADROOM times the nominal size) and other metadata block
+        num_segments = CHECKPOINT_HEADROOM * self.num_segments + 1
+        checkpoint = CheckpointBlock(
+            [-1] * self.num_imap_ptrs_in_cr,
+            [0] * num_segments,
+            [0] * num_segments,
+            0,
+            0,
+            0,
+            0,
+            0,
+        )
+        blocks = [
+            self.make_inode(INODE_REGULAR, 0, 0),
+            ImapChunk([-1] * self.num_inodes_per_imap_chunk),
+        ]
+        if self.num_indirect_ptrs:
+            blocks.append(self.make_indirect_block())
+        if self.num_imap_chunks_per_index:
+            blocks.append(ImapIndex([-1] * self.num_imap_chunks_per_index))
+        return len(encode_block(checkpoint)), max(
+            len(encode_block(block)) for block in blocks
+        )
+
     def make_data_block(self, data):
-        return {"block_type": BLOCK_TYPE_DATA_BLOCK, "contents": data}
+        return DataBlock(data)
 
     def make_inode(self, itype, size, refs):
-        return {
-            "block_type": BLOCK_TYPE_INODE,
-            "type": itype,
-            "size": size,
-            "refs": refs,
-            "pointers": [-1] * NUM_INODE_PTRS,
-        }
+        return Inode(itype, size, refs, [-1] * self.num_pointers)
+
+    def make_indirect_block(self):
+        return IndirectBlock([-1] * self.num_indirect_ptrs)
 
     def make_new_dirblock(self, parent_inum, current_inum):
         dirblock = self.make_empty_dirblock()
-        dirblock["entries"][0] = (".", current_inum)
-        dirblock["entries"][1] = ("..", parent_inum)
+        dirblock.entries[0] = (".", current_inum)
+        dirblock.entries[1] = ("..", parent_inum)
         return dirblock
 
     def make_empty_dirblock(self):
-        return {
-            "block_type": BLOCK_TYPE_DATA_DIRECTORY,
-            "entries": [
+        return DirectoryBlock(
+            [
                 ("-", -1),
                 ("-", -1),
                 ("-", -1),
                 ("-", -1),
-            ],
-        }
+            ]
+        )
 
     def make_imap_chunk(self, cnum):
-        imap_chunk = {}
-        imap_chunk["block_type"] = BLOCK_TYPE_IMAP
-        imap_chunk["entries"] = list()
-        start = cnum * NUM_INODES_PER_IMAP_CHUNK
-        for i in range(start, start + NUM_INODES_PER_IMAP_CHUNK):
-            imap_chunk["entries"].append(self.inode_map[i])
-        return imap_chunk
+        start = cnum * self.num_inodes_per_imap_chunk
+        return ImapChunk(
+            [
+                self.inode_map[i]
+                for i in range(start, start + self.num_inodes_per_imap_chunk)
+            ]
+        )
+
+    def make_imap_index(self, index):
+        start = index * self.num_imap_chunks_per_index
+        return ImapIndex(self.cr[start : start + self.num_imap_chunks_per_index])
 
     def make_random_blocks(self, num):
         contents = []
         for i in range(num):
-            L = chr(ord("a") + int(random.random() * 26))
+            L = chr(ord("a") + int(self.rng.random() * 26))
             contents.append(str(16 * ("%s%d" % (L, i))))
         return contents
 
     def inum_to_chunk(self, inum):
-        return int(inum / NUM_INODES_PER_IMAP_CHUNK)
+        return int(inum / self.num_inodes_per_imap_chunk)
 
-    def determine_liveness(self):
-        # first, assume all are dead
-        self.live = {}
-        for i in range(len(self.disk)):
-            self.live[i] = False
+    def address_to_segment(self, address):
+        return (address - ADDR_LOG_START) // SEGMENT_SIZE
 
-        # checkpoint region
-        self.live[0] = True
+    def segment_addresses(self, snum):
+        start = ADDR_LOG_START + snum * SEGMENT_SIZE
+        return range(start, min(start + SEGMENT_SIZE, len(self.disk)))
 
-        # now mark latest pieces of imap as live
-        for ptr in self.cr:
+    def blocks_in_use(self):
+        return len(self.disk) - len(self.clean_segments) * SEGMENT_SIZE
+
+    def count_segment_usage(self):
+        # rebuild the segment usage table from the current liveness info
+        num_segments = max(
+            self.num_segments, self.address_to_segment(len(self.disk) - 1) + 1
+        )
+        self.segment_live = [0] * num_segments
+        self.segment_mtime = [0] * num_segments
+        for i in range(ADDR_LOG_START, len(self.disk)):
+            snum = self.address_to_segment(i)
+            if snum in self.clean_segments:
+                continue
+            if self.live[i]:
+                self.segment_live[snum] += 1
+            self.segment_mtime[snum] = max(
+                self.segment_mtime[snum], self.disk.summary(i)[1]
+            )
+        return
+
+    def determine_liveness(self):
+        # full rescan; liveness is normally maintained as blocks are logged
+        # and superseded, this rebuilds it from scratch (e.g. to verify it)
+        # first, assume all are dead (and, with dedup, unshared)
+        self.live = bytearray(len(self.disk))
+        self.fingerprints = {}
+        self.block_refs = {}
+
+        # checkpoint regions
+        for address in ADDR_CHECKPOINT_BLOCKS:
+            self.live[address] = 1
+
+        # now mark latest pieces of imap (and imap index blocks) as live
+        for ptr in self.cr + self.imap_index:
             if ptr == -1:
                 continue
-            self.live[ptr] = True
+            self.live[ptr] = 1
 
         # go through imap, find live inodes and their addresses
         # latest inodes are all live, by def
         inodes = []
         for i in range(len(self.inode_map)):
-            if self.inode_map[i] == -1:
+            if self.inode_map[i] < 0:
                 continue
-            self.live[self.inode_map[i]] = True
+            if self.inode_map[i] < ADDR_BUFFER_BASE:
+                self.live[self.inode_map[i]] = 1
             inodes.append(i)
 
         # go through live inodes and find blocks each points to
         for i in inodes:
-            inode = self.disk[self.inode_map[i]]
-            for ptr in inode["pointers"]:
-                self.live[ptr] = True
+            inode = self.read_block(self.inode_map[i])
+            for j in range(len(inode.pointers)):
+                self.__mark_tree(inode.pointers[j], self.pointer_index(j), i)
+
+        self.count_segment_usage()
         return
 
+    def __mark_live(self, address):
+        if address < ADDR_LOG_START or address >= ADDR_BUFFER_BASE:
+            return
+        if not self.live[address]:
+            self.live[address] = 1
+            self.segment_live[self.address_to_segment(address)] += 1
+        return
+
+    def __mark_dead(self, address):
+        # a block dies once nothing points at it anymore
+        if address < ADDR_LOG_START or address >= ADDR_BUFFER_BASE:
+            return
+        if self.live[address]:
+            self.live[address] = 0
+            self.segment_live[self.address_to_segment(address)] -= 1
+        return
+
+    def __mark_tree(self, address, index, inum):
+        # a block and, for indirect blocks, everything under it
+        if address == -1:
+            return
+        if address < ADDR_BUFFER_BASE:
+            self.live[address] = 1
+        if index < -1:
+            pointers = self.read_block(address).pointers
+            for j in range(len(pointers)):
+                self.__mark_tree(pointers[j], self.child_index(index, j), inum)
+        elif self.dedup and address < ADDR_BUFFER_BASE:
+            block = self.disk[address]
+            if block.block_type == BLOCK_TYPE_DATA_BLOCK:
+                self.__add_ref(address, block, inum, index)
+        return
+
+    def fingerprint(self, contents):
+        # content hash of a data block, its key in the dedup index
+        return hashlib.blake2b(contents.encode(), digest_size=FINGERPRINT_SIZE).digest()
+
+    def __add_ref(self, address, block, inum, index):
+        # block `index` of file `inum` points at the data block at address
+        refs = self.block_refs.get(address)
+        if refs is None:
+            refs = self.block_refs[address] = set()
+            self.fingerprints.setdefault(self.fingerprint(block.contents), address)
+        refs.add((inum, index))
+        return
+
+    def __drop_ref(self, address, inum, index):
+        # false as long as other file blocks still point at the block
+        refs = self.block_refs.get(address)
+        if refs is None:
+            return True
+        refs.discard((inum, index))
+        if refs:
+            return False
+        del self.block_refs[address]
+        key = self.fingerprint(self.disk[address].contents)
+        if self.fingerprints.get(key) == address:
+            del self.fingerprints[key]
+        return True
+
+    def __supersede(self, old_inode, new_inode, inum):
+        # blocks the old version of an inode points at, and the new one doesn't
+        for i in range(len(old_inode.pointers)):
+            new_address = -1
+            if new_inode is not None:
+                new_address = new_inode.pointers[i]
+            self.__supersede_pointer(
+                old_inode.pointers[i], new_address, self.pointer_index(i), inum
+            )
+        return
+
+    def __supersede_pointer(self, old_address, new_address, index, inum):
+        if old_address == new_address or old_address == -1:
+            return
+        if self.block_refs and index >= 0:
+            if not self.__drop_ref(old_address, inum, index):
+                return
+        self.__mark_dead(old_address)
+        if index < -1:
+            # an indirect block: compare what the two versions point at
+            old_pointers = self.read_block(old_address).pointers
+            new_pointers = [-1] * len(old_pointers)
+            if new_address != -1:
+                new_pointers = self.read_block(new_address).pointers
+            for j in range(len(old_pointers)):
+                self.__supersede_pointer(
+                    old_pointers[j], new_pointers[j], self.child_index(index, j), inum
+                )
+        return
+
+    def pointer_index(self, i):
+        # segment summary index of what the i-th pointer of an inode points at
+        if i < self.num_inode_ptrs:
+            return i
+        elif i == self.num_inode_ptrs:
+            return SUMMARY_INDIRECT
+        return SUMMARY_DOUBLE_INDIRECT
+
+    def child_index(self, index, j):
+        # segment summary index of what the j-th pointer of an indirect block
+        # (itself at summary index `index`) points at
+        if index == SUMMARY_INDIRECT:
+            return self.num_inode_ptrs + j
+        elif index == SUMMARY_DOUBLE_INDIRECT:
+            return SUMMARY_DOUBLE_INDIRECT_BASE - j
+        k = SUMMARY_DOUBLE_INDIRECT_BASE - index
+        return (
+            self.num_inode_ptrs
+            + self.num_indirect_ptrs
+            + k * self.num_indirect_ptrs
+            + j
+        )
+
+    def bmap(self, inode, block_number):
+        # address of a file block, going through indirect blocks if need be
+        if block_number < self.num_inode_ptrs:
+            return inode.pointers[block_number]
+        block_number -= self.num_inode_ptrs
+        if block_number < self.num_indirect_ptrs:
+            address = inode.pointers[self.num_inode_ptrs]
+            if address == -1:
+                return -1
+            return self.read_block(address).pointers[block_number]
+        block_number -= self.num_indirect_ptrs
+        address = inode.pointers[self.num_inode_ptrs + 1]
+        if address == -1:
+            return -1
+        address = self.read_block(address).pointers[
+            block_number // self.num_indirect_ptrs
+        ]
+        if address == -1:
+            return -1
+        return self.read_block(address).pointers[block_number % self.num_indirect_ptrs]
+
+    def __set_pointers(self, inum, inode, updates, log, relog=()):
+        # point a new version of an inode at new file blocks (updates maps
+        # block number -> address), logging a new version of only those
+        # indirect blocks on the way to them (plus any listed in relog)
+        single = {}
+        double = {}
+        for index in relog:
+            if index <= SUMMARY_DOUBLE_INDIRECT_BASE:
+                double[SUMMARY_DOUBLE_INDIRECT_BASE - index] = {}
+        for block_number, address in updates.items():
+            if block_number < self.num_inode_ptrs:
+                inode.pointers[block_number] = address
+                continue
+            block_number -= self.num_inode_ptrs
+            if block_number < self.num_indirect_ptrs:
+                single[block_number] = address
+                continue
+            block_number -= self.num_indirect_ptrs
+            double.setdefault(block_number // self.num_indirect_ptrs, {})[
+                block_number % self.num_indirect_ptrs
+            ] = address
+
+        if single or SUMMARY_INDIRECT in relog:
+            inode.pointers[self.num_inode_ptrs] = self.__log_indirect(
+                inum, SUMMARY_INDIRECT, inode.pointers[self.num_inode_ptrs], single, log
+            )
+        if double or SUMMARY_DOUBLE_INDIRECT in relog:
+            top = {}
+            address = inode.pointers[self.num_inode_ptrs + 1]
+            pointers = [-1] * self.num_indirect_ptrs
+            if address != -1:
+                pointers = self.read_block(address).pointers
+            for k in sorted(double):
+                top[k] = self.__log_indirect(
+                    inum, SUMMARY_DOUBLE_INDIRECT_BASE - k, pointers[k], double[k], log
+                )
+            inode.pointers[self.num_inode_ptrs + 1] = self.__log_indirect(
+                inum, SUMMARY_DOUBLE_INDIRECT, address, top, log
+            )
+        return
+
+    def __log_indirect(self, inum, index, address, updates, log):
+        if address == -1:
+            block = self.make_indirect_block()
+        else:
+            block = self.read_block(address).copy()
+        for j, pointer in updates.items():
+            block.pointers[j] = pointer
+        return log(block, (inum, index))
+
     def gc(self):
-        self.determine_liveness()
-        block_no_mappings = {}
-        block_index_new = 0
-        block_nos_old = []
-        for i in range(len(self.disk)):
-            if self.live[i]:
-                block_nos_old.append(i)
-        block_nos_old.sort()
-
-        # map old block number to new index
-        for i in block_nos_old:
-            block_no_mappings[i] = block_index_new
-            block_index_new += 1
-
-        # update block numbers in inodes
-        for i in block_nos_old:
-            block = copy.deepcopy(self.disk[i])
-            block_type = block["block_type"]
-            if block_type == BLOCK_TYPE_INODE:
-                pointers = block["pointers"]
-                for j in range(len(pointers)):
-                    value = pointers[j]
-                    if value in block_no_mappings:
-                        pointers[j] = block_no_mappings[value]
-            elif block_type in [BLOCK_TYPE_IMAP, BLOCK_TYPE_CHECKPOINT]:
-                entries = block["entries"]
-                for j in range(len(entries)):
-                    value = entries[j]
-                    if value in block_no_mappings:
-                        entries[j] = block_no_mappings[value]
-            self.disk[block_no_mappings[i]] = block
+        if self.instrument:
+            start = time.perf_counter()
+        self.flush()
+        self.gc_count += 1
+        num_blocks = len(self.disk)
+
+        # new address of a live block: the number of live blocks before it,
+        # i.e. a prefix sum over the liveness array; the extra last entry is
+        # -1, so that relocation[-1] keeps null pointers null
+        relocation = array.array("q", itertools.accumulate(self.live, initial=0))
+        block_num_cur = relocation[num_blocks]
+        relocation[num_blocks] = -1
+
+        # one pass over the live blocks in address order, each moving down
+        # over blocks already done; this is the one place logged blocks are
+        # changed, and only their addresses, in the object read from disk
+        for i in itertools.compress(range(num_blocks), self.live):
+            block = self.disk[i]
+            block_type = block.block_type
+            if block_type == BLOCK_TYPE_INODE or block_type == BLOCK_TYPE_INDIRECT:
+                block.pointers = [relocation[value] for value in block.pointers]
+            elif (
+                block_type == BLOCK_TYPE_IMAP
+                or block_type == BLOCK_TYPE_IMAP_INDEX
+                or block_type == BLOCK_TYPE_CHECKPOINT
+            ):
+                # (a checkpoint's entries may be stale, but it is rewritten below)
+                block.entries = [relocation[value] for value in block.entries]
+            self.disk.write(relocation[i], block, self.disk.summary(i))
 
         # remove cleaned blocks
-        block_num_prev = len(self.disk)
-        block_num_cur = len(block_no_mappings)
-        self.disk = self.disk[:block_num_cur]
+        # (costed like the cleaner: everything in use read, the live part
+        # written back)
+        block_num_prev = self.blocks_in_use()
+        self.blocks_written += block_num_cur
+        self.clean_stats["read"] += block_num_prev
+        self.clean_stats["written"] += block_num_cur
+        self.clean_stats["freed"] += block_num_prev - block_num_cur
+        self.clean_stats["moved"] += block_num_cur
+        self.disk.truncate(block_num_cur)
+        self.clean_segments = set()
+        self.log_tail = block_num_cur
+        self.cold_tail = -1
+        if self.dump_pending is not None:
+            self.dump_pending = []
         print(
             f"Garbage collection finished, reduced {block_num_prev} blocks to {block_num_cur} now."
         )
         print(f"Saved {(block_num_prev - block_num_cur) / block_num_prev}% space.")
 
         # update inode map in memory
-        for i in range(len(self.inode_map)):
-            block_no = self.inode_map[i]
-            if block_no != -1:
-                self.inode_map[i] = block_no_mappings[block_no]
+        inode_map = self.inode_map
+        for i in inode_map:
+            inode_map[i] = relocation[inode_map[i]]
+
+        # and the in-memory checkpoint region, so later syncs stay valid
+        self.cr = [relocation[value] for value in self.cr]
+        self.imap_index = [relocation[value] for value in self.imap_index]
+
+        # and the dedup index
+        self.fingerprints = {
+            key: relocation[address] for key, address in self.fingerprints.items()
+        }
+        self.block_refs = {
+            relocation[address]: refs for address, refs in self.block_refs.items()
+        }
+
+        # everything cached points at old addresses
+        self.inode_cache.clear()
+        self.imap_cache.clear()
+        self.read_cache.clear()
+
+        # every block left is live, so segment usage can be rebuilt directly
+        self.live = bytearray(b"\x01") * block_num_cur
+        self.count_segment_usage()
+        self.cr_sync()
+        if self.instrument:
+            self.__count("gc.copied", block_num_cur)
+            self.__event(
+                "gc",
+                time.perf_counter() - start,
+                copied=block_num_cur,
+                freed=block_num_prev - block_num_cur,
+            )
+
+    def __pick_victims(self, max_blocks=None):
+        # candidates: fully written segments that still have something to free
+        tail_segments = {self.address_to_segment(self.log_tail - 1)}
+        if self.cold_tail != -1:
+            tail_segments.add(self.address_to_segment(self.cold_tail - 1))
+        candidates = []
+        for snum in range(self.address_to_segment(len(self.disk) - 1) + 1):
+            if snum in tail_segments or snum in self.clean_segments:
+                continue
+            live = self.segment_live[snum]
+            if live == SEGMENT_SIZE:
+                continue
+            if self.clean_policy == CLEAN_GREEDY:
+                score = -live
+            else:
+                u = live / SEGMENT_SIZE
+                age = self.clock - self.segment_mtime[snum]
+                score = (1 - u) * age / (1 + u)
+            candidates.append((score, -snum))
+        candidates.sort(reverse=True)
+
+        # take the best ones until enough space would be freed (with a
+        # budget, skipping those with more live blocks to move than is left)
+        needed = self.blocks_in_use() - self.num_blocks * CLEAN_TARGET
+        victims = []
+        to_move = 0
+        for score, snum in candidates:
+            if needed <= 0:
+                break
+            live = self.segment_live[-snum]
+            if max_blocks is not None and to_move + live > max_blocks:
+                continue
+            victims.append(-snum)
+            to_move += live
+            needed -= SEGMENT_SIZE - live
+        return victims
+
+    def clean(self, max_blocks=None):
+        # max_blocks makes this one bounded, quiet step of incremental cleaning
+        if not self.instrument:
+            return self.__clean(max_blocks)
+        start = time.perf_counter()
+        clean_stats = dict(self.clean_stats)
+        self.__clean(max_blocks)
+        moved = self.clean_stats["moved"] - clean_stats["moved"]
+        self.__count("clean.moved", moved)
+        self.__event(
+            "clean",
+            time.perf_counter() - start,
+            bounded=max_blocks is not None,
+            segments=self.clean_stats["segments"] - clean_stats["segments"],
+            moved=moved,
+            freed=self.clean_stats["freed"] - clean_stats["freed"],
+        )
+        return
+
+    def __clean(self, max_blocks):
+        self.flush()
+        if self.clean_policy == CLEAN_COMPACT:
+            self.gc()
+            return
+        if max_blocks is None:
+            self.gc_count += 1
+        else:
+            self.clean_steps += 1
+        victims = self.__pick_victims(max_blocks)
+        if len(victims) == 0:
+            if max_blocks is None:
+                print("Nothing to clean.")
+            return
+        blocks_written = self.blocks_written
+        disk_len = self.blocks_in_use()
+
+        # with separate streams, the cold one needs a segment to move blocks
+        # into: after a checkpoint nothing on disk refers to victims that have
+        # nothing live left, so those can be reused straight away
+        empty = []
+        if self.hot_age:
+            empty = [snum for snum in victims if self.segment_live[snum] == 0]
+            if empty:
+                self.cr_sync()
+                self.__free_segments(empty)
+
+        # live blocks in the victims, oldest first, so blocks of similar age
+        # end up in the same segments again
+        survivors = []
+        for snum in victims:
+            for address in self.segment_addresses(snum):
+                if self.live[address]:
+                    survivors.append((self.disk.summary(address)[1], address))
+        survivors.sort()
+
+        # copy them out, collecting the new pointer values
+        moved = 0
+        relocated = {}
+        moved_chunks = set()
+        moved_indexes = set()
+        for mtime, address in survivors:
+            moved += 1
+            block = self.disk[address]
+            serial, mtime, inum, index = self.disk.summary(address)
+            block_type = block.block_type
+            if block_type == BLOCK_TYPE_IMAP:
+                moved_chunks.add(inum)
+                continue
+            if block_type == BLOCK_TYPE_IMAP_INDEX:
+                moved_indexes.add(inum)
+                continue
+            # inodes are rewritten below along with any moved pointers,
+            # and indirect blocks along with what they point at
+            if block_type == BLOCK_TYPE_INODE:
+                relocated.setdefault(inum, ({}, set()))
+                continue
+            if block_type == BLOCK_TYPE_INDIRECT:
+                relocated.setdefault(inum, ({}, set()))[1].add(index)
+                continue
+            # a deduplicated block is pointed at by every file sharing it
+            # (and the one that logged it may not be one of them anymore)
+            refs = self.block_refs.pop(address, None)
+            if refs is None:
+                assert (
+                    self.bmap(self.read_block(self.inode_map[inum]), index) == address
+                )
+                owners = ((inum, index),)
+            else:
+                owners = sorted(refs)
+                inum, index = owners[0]
+            # it keeps its age, and goes with the other cold data
+            new_address = self.__append(block, (inum, index), STREAM_COLD, mtime)
+            if refs is not None:
+                self.block_refs[new_address] = refs
+                self.fingerprints[self.fingerprint(block.contents)] = new_address
+            for owner, block_number in owners:
+                relocated.setdefault(owner, ({}, set()))[0][block_number] = new_address
+
+        # new versions of the inodes involved
+        for inum in sorted(relocated):
+            pointers, relog = relocated[inum]
+            new_inode = self.read_block(self.inode_map[inum]).copy()
+            self.__set_pointers(inum, new_inode, pointers, self.__append, relog)
+            self.remap(inum, self.__append(new_inode, (inum, -1), STREAM_COLD))
+            self.dirty_chunks.add(self.inum_to_chunk(inum))
+
+        # imap chunks pointing at the new inodes (or moved themselves), then the checkpoint
+        self.__flush_imap(moved_chunks, moved_indexes)
+        self.cr_sync()
+
+        # all of the above went straight to disk, so nothing is left buffered
+        self.buffer_imap_base = {}
+
+        # victims are now free to be written again
+        self.__free_segments([snum for snum in victims if snum not in empty])
+
+        read = len(victims) * SEGMENT_SIZE
+        written = self.blocks_written - blocks_written
+        freed = read - moved
+        self.clean_stats["segments"] += len(victims)
+        self.clean_stats["read"] += read
+        self.clean_stats["written"] += written
+        self.clean_stats["freed"] += freed
+        self.clean_stats["moved"] += moved
+        if max_blocks is not None:
+            return
+        print(
+            f"Cleaning finished, freed {len(victims)} segments, {disk_len} blocks in use reduced to {self.blocks_in_use()} now."
+        )
+        print(
+            f"Cleaning cost: {(read + written) / freed} blocks read and written per block freed."
+        )
+        return
+
+    def __free_segments(self, segments):
+        for snum in segments:
+            assert self.segment_live[snum] == 0
+            self.clean_segments.add(snum)
+            self.segment_mtime[snum] = 0
+        return
+
+    def clean_cost(self):
+        if self.clean_stats["freed"] == 0:
+            return 0
+        return (
+            self.clean_stats["read"] + self.clean_stats["written"]
+        ) / self.clean_stats["freed"]
+
+    def add_hook(self, hook):
+        # hook(event, seconds, fields) is called for every event from now on
+        self.hooks.append(hook)
+        self.instrument = True
+        return
+
+    def __event(self, event, seconds=0.0, **fields):
+        self.counters[event] = self.counters.get(event, 0) + 1
+        if seconds:
+            self.timers[event] = self.timers.get(event, 0.0) + seconds
+        for hook in self.hooks:
+            hook(event, seconds, fields)
+        return
+
+    def __count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+        return
 
     def error_log(self, s):
         self.error_list.append(s)
+        if self.instrument:
+            self.__event("error", message=s)
         return
 
     def error_clear(self):
@@ -234,24 +1659,23 @@ class LFS:
 
     def dump_partial(self, show_liveness, show_checkpoint):
         if show_checkpoint or not self.no_force_checkpoints:
-            self.__dump(0, 1)
+            self.__dump([self.checkpoint_address])
         if not self.no_force_checkpoints:
             print("...")
-        self.__dump(self.dump_last, len(self.disk))
-        self.dump_last = len(self.disk)
+        self.__dump(self.dump_pending or [])
+        self.dump_pending = []
         return
 
     def dump(self):
-        self.__dump(0, len(self.disk))
+        self.__dump(range(len(self.disk)))
+        self.dump_pending = []
         return
 
-    def __dump(self, start, end):
-        self.determine_liveness()
-
-        for i in range(start, end):
+    def __dump(self, addresses):
+        for i in addresses:
             # print ADDRESS on disk
             b = self.disk[i]
-            block_type = b["block_type"]
+            block_type = b.block_type
             print("[ %3d ]" % i, end="")
 
             # print LIVENESS
@@ -262,38 +1686,54 @@ class LFS:
 
             if block_type == BLOCK_TYPE_CHECKPOINT:
                 print("checkpoint:", end=" ")
-                for e in b["entries"]:
+                for e in b.entries:
                     if e != -1:
                         print(e, end=" ")
                     else:
                         print("--", end=" ")
                 print("")
             elif block_type == BLOCK_TYPE_DATA_DIRECTORY:
-                for e in b["entries"]:
+                for e in b.entries:
                     if e[1] != -1:
                         print("[%s,%s]" % (str(e[0]), str(e[1])), end=" ")
                     else:
                         print("--", end=" ")
                 print("")
             elif block_type == BLOCK_TYPE_DATA_BLOCK:
-                print(b["contents"])
+                print(b.contents)
             elif block_type == BLOCK_TYPE_INODE:
                 print(
-                    "type:" + b["type"],
-                    "size:" + str(b["size"]),
-                    "refs:" + str(b["refs"]),
+                    "type:" + b.type,
+                    "size:" + str(b.size),
+                    "refs:" + str(b.refs),
                     "ptrs:",
                     end=" ",
                 )
-                for p in b["pointers"]:
+                for p in b.pointers:
                     if p != -1:
                         print("%s" % p, end=" ")
                     else:
                         print("--", end=" ")
                 print("")
+            elif block_type == BLOCK_TYPE_INDIRECT:
+                print("indirect:", end=" ")
+                for p in b.pointers:
+                    if p != -1:
+                        print("%s" % p, end=" ")
+                    else:
+                        print("--", end=" ")
+                print("")
+            elif block_type == BLOCK_TYPE_IMAP_INDEX:
+                print("index(imap):", end=" ")
+                for e in b.entries:
+                    if e != -1:
+                        print(e, end=" ")
+                    else:
+                        print("--", end=" ")
+                print("")
             elif block_type == BLOCK_TYPE_IMAP:
                 print("chunk(imap):", end=" ")
-                for e in b["entries"]:
+                for e in b.entries:
                     if e != -1:
                         print(e, end=" ")
                     else:
@@ -304,24 +1744,257 @@ class LFS:
                 exit(1)
         return
 
-    def log(self, block):
-        new_address = len(self.disk)
-        self.disk.append(copy.deepcopy(block))
+    def log(self, block, summary):
+        if self.write_buffer_size:
+            # the summary is worked out again when the buffer is flushed
+            new_address = ADDR_BUFFER_BASE + len(self.buffer)
+            self.buffer.append(block)
+            return new_address
+        return self.__append(block, summary)
+
+    def __next_log_address(self, stream):
+        tail = self.log_tail
+        if stream == STREAM_COLD:
+            tail = self.cold_tail
+        if tail != -1 and (tail - ADDR_LOG_START) % SEGMENT_SIZE != 0:
+            return tail
+        # current segment is full: reuse a cleaned one, or extend the log
+        if len(self.clean_segments) > 0:
+            snum = min(self.clean_segments)
+            self.clean_segments.remove(snum)
+            return ADDR_LOG_START + snum * SEGMENT_SIZE
+        if stream == STREAM_COLD:
+            # only the main log extends the disk
+            return -1
+        return len(self.disk)
+
+    def __stream(self, block, inum):
+        if self.hot_age and block.block_type == BLOCK_TYPE_DATA_BLOCK:
+            if inum not in self.hot_files:
+                return STREAM_COLD
+        return STREAM_HOT
+
+    def __append(self, block, summary, stream=None, mtime=None):
+        if self.instrument:
+            start = time.perf_counter()
+        inum, index = summary
+        if not self.hot_age:
+            stream = STREAM_HOT
+        elif stream is None:
+            stream = self.__stream(block, inum)
+        new_address = self.__next_log_address(stream)
+        if new_address == -1:
+            # no segment for the cold stream, so it shares the main one
+            stream = STREAM_HOT
+            new_address = self.__next_log_address(stream)
+        if mtime is None:
+            mtime = self.clock
+        if new_address == len(self.disk):
+            self.live.append(1)
+        else:
+            self.live[new_address] = 1
+            # a reused address no longer holds what the read cache has
+            self.read_cache.invalidate(new_address)
+        self.disk.write(new_address, block, (self.blocks_written, mtime, inum, index))
+        if stream == STREAM_COLD:
+            self.cold_tail = new_address + 1
+        else:
+            self.log_tail = new_address + 1
+        self.blocks_written += 1
+        self.blocks_by_type[block.block_type] = (
+            self.blocks_by_type.get(block.block_type, 0) + 1
+        )
+        if self.dump_pending is not None:
+            self.dump_pending.append(new_address)
+
+        # account for the new block in its segment
+        snum = self.address_to_segment(new_address)
+        if snum == len(self.segment_live):
+            # log has outgrown the nominal disk size
+            self.segment_live.append(0)
+            self.segment_mtime.append(0)
+        self.segment_live[snum] += 1
+        self.segment_mtime[snum] = max(self.segment_mtime[snum], mtime)
+        if self.instrument:
+            self.__count("log." + block.block_type)
+            self.__event(
+                "log",
+                time.perf_counter() - start,
+                block_type=block.block_type,
+                address=new_address,
+                inum=inum,
+            )
         return new_address
 
-    def allocate_inode(self):
-        for i in range(len(self.inode_map)):
-            if self.inode_map[i] == -1:
-                self.inode_map[i] = 1
-                return i
-        return -1
+    def read_block(self, address):
+        if address >= ADDR_BUFFER_BASE:
+            return self.buffer[address - ADDR_BUFFER_BASE]
+        return self.disk[address]
+
+    def __buffer_touch(self, inum):
+        # remember where the inode lived before the buffer first changed it
+        if self.write_buffer_size and inum not in self.buffer_imap_base:
+            self.buffer_imap_base[inum] = self.inode_map[inum]
+        return
+
+    def __flush_block(self, address, old_address, summary):
+        # log a buffered block, unless it ended up identical to the one it replaces
+        if address < ADDR_BUFFER_BASE:
+            return address
+        block = self.buffer[address - ADDR_BUFFER_BASE]
+        if old_address != -1 and self.disk[old_address] == block:
+            # superseded while buffered, but back in use after all
+            self.__mark_live(old_address)
+            if self.dedup and block.block_type == BLOCK_TYPE_DATA_BLOCK:
+                self.__add_ref(old_address, block, *summary)
+            return old_address
+        if not self.dedup or block.block_type != BLOCK_TYPE_DATA_BLOCK:
+            return self.__append(block, summary)
+        # contents that made it to disk while this one was buffered
+        address = self.fingerprints.get(self.fingerprint(block.contents), -1)
+        if address != -1:
+            self.dedup_hits += 1
+        else:
+            address = self.__append(block, summary)
+        self.__add_ref(address, block, *summary)
+        return address
+
+    def __flush_pointer(self, address, old_address, inum, index):
+        # a buffered indirect block is logged after what it points at
+        if address >= ADDR_BUFFER_BASE and index < -1:
+            pointers = self.buffer[address - ADDR_BUFFER_BASE].pointers
+            old_pointers = [-1] * len(pointers)
+            if old_address != -1:
+                old_pointers = self.disk[old_address].pointers
+            for j in range(len(pointers)):
+                pointers[j] = self.__flush_pointer(
+                    pointers[j], old_pointers[j], inum, self.child_index(index, j)
+                )
+        return self.__flush_block(address, old_address, (inum, index))
+
+    def flush(self):
+        if len(self.buffer) == 0 and len(self.dirty_chunks) == 0:
+            return 0
+        blocks_written = self.blocks_written
+
+        # write the final version of every touched inode (and what it points to)
+        for inum in sorted(self.buffer_imap_base):
+            old_inode_address = self.buffer_imap_base[inum]
+            inode_address = self.inode_map[inum]
+            if inode_address == -1:
+                # deleted (or created and deleted within the same batch)
+                continue
+            if inode_address < ADDR_BUFFER_BASE:
+                # already on disk (e.g. moved there by the cleaner)
+                continue
+            old_inode = None
+            if old_inode_address != -1:
+                old_inode = self.disk[old_inode_address]
+            inode = self.read_block(inode_address)
+            if old_inode is not None and old_inode.type == inode.type:
+                old_pointers = old_inode.pointers
+            else:
+                old_pointers = [-1] * self.num_pointers
+            for i in range(self.num_pointers):
+                inode.pointers[i] = self.__flush_pointer(
+                    inode.pointers[i], old_pointers[i], inum, self.pointer_index(i)
+                )
+            self.inode_map[inum] = self.__flush_block(
+                inode_address, old_inode_address, (inum, -1)
+            )
+            self.inode_cache.invalidate(inum)
+
+        self.buffer = []
+        self.buffer_imap_base = {}
+
+        # each dirty imap chunk goes out once, and a single checkpoint for the
+        # whole batch (other policies leave both to the next checkpoint)
+        if self.checkpoint_policy == CHECKPOINT_EVERY_OP:
+            self.__flush_imap()
+            if not self.no_force_checkpoints:
+                self.cr_sync()
+        return self.blocks_written - blocks_written
+
+    def __flush_imap(self, moved=(), moved_indexes=()):
+        indexes = set(moved_indexes)
+        for cnum in sorted(self.dirty_chunks | set(moved)):
+            imap_chunk = self.make_imap_chunk(cnum)
+            if (
+                cnum not in moved
+                and self.cr[cnum] != -1
+                and self.disk[self.cr[cnum]] == imap_chunk
+            ):
+                continue
+            self.__mark_dead(self.cr[cnum])
+            self.cr[cnum] = self.__append(imap_chunk, (cnum, -1))
+            self.imap_cache.invalidate(cnum)
+            if self.num_imap_chunks_per_index:
+                indexes.add(cnum // self.num_imap_chunks_per_index)
+        self.dirty_chunks = set()
+
+        # with a two-level imap, index blocks pointing at the new chunks
+        for index in sorted(indexes):
+            self.__mark_dead(self.imap_index[index])
+            self.imap_index[index] = self.__append(
+                self.make_imap_index(index), (index, -1)
+            )
+        return
+
+    def allocate_inode(self, parent_inode_number=ROOT_INODE):
+        cnum = -1
+        if self.inode_policy == ALLOCATE_LOCALITY:
+            # keep new inodes in the parent's imap chunk, so both entries are
+            # rewritten with one chunk
+            cnum = self.inum_to_chunk(parent_inode_number)
+            if not self.free_inodes[cnum]:
+                cnum = -1
+        if cnum == -1:
+            # the lowest numbered chunk with a free inode, dropping those that
+            # filled up since they were queued
+            free_chunks = self.free_chunks
+            while free_chunks and not self.free_inodes[free_chunks[0]]:
+                self.free_chunk_queued[heapq.heappop(free_chunks)] = 0
+            if not free_chunks:
+                return -1
+            cnum = free_chunks[0]
+        # lowest set bit is the lowest free inode number in the chunk
+        free = self.free_inodes[cnum]
+        self.free_inodes[cnum] = free & (free - 1)
+        i = cnum * self.num_inodes_per_imap_chunk + (free & -free).bit_length() - 1
+        self.__buffer_touch(i)
+        self.inode_map[i] = ADDR_ALLOCATED
+        return i
 
     def free_inode(self, inum):
         assert self.inode_map[inum] != -1
+        self.__buffer_touch(inum)
+        self.inode_cache.invalidate(inum)
+        old_address = self.inode_map[inum]
+        if old_address >= 0:
+            # the inode, and everything it points at, is dead now
+            self.__supersede(self.read_block(old_address), None, inum)
+            self.__mark_dead(old_address)
         self.inode_map[inum] = -1
+        cnum, bit = divmod(inum, self.num_inodes_per_imap_chunk)
+        self.free_inodes[cnum] |= 1 << bit
+        if not self.free_chunk_queued[cnum]:
+            self.free_chunk_queued[cnum] = 1
+            heapq.heappush(self.free_chunks, cnum)
+        self.last_write.pop(inum, None)
+        self.hot_files.discard(inum)
         return
 
     def remap(self, inode_number, inode_address):
+        self.__buffer_touch(inode_number)
+        self.inode_cache.invalidate(inode_number)
+        old_address = self.inode_map[inode_number]
+        if old_address >= 0:
+            self.__supersede(
+                self.read_block(old_address),
+                self.read_block(inode_address),
+                inode_number,
+            )
+            self.__mark_dead(old_address)
         self.inode_map[inode_number] = inode_address
         return
 
@@ -332,50 +2005,146 @@ class LFS:
         print("")
         return
 
+    def segment_utilization(self, buckets=10):
+        # how many written segments are how full: counts per utilization range
+        histogram = [0] * buckets
+        for snum in range(len(self.segment_live)):
+            if snum in self.clean_segments or len(self.segment_addresses(snum)) == 0:
+                continue
+            u = self.segment_live[snum] / SEGMENT_SIZE
+            histogram[min(int(u * buckets), buckets - 1)] += 1
+        return histogram
+
+    def dump_segment_usage(self):
+        for snum in range(len(self.segment_live)):
+            if len(self.segment_addresses(snum)) == 0:
+                continue
+            print(
+                "  segment %3d: live %2d/%d mtime %d"
+                % (
+                    snum,
+                    self.segment_live[snum],
+                    SEGMENT_SIZE,
+                    self.segment_mtime[snum],
+                )
+            )
+        print("")
+        return
+
     def cr_sync(self):
-        # only place in code where an OVERWRITE occurs
-        self.disk[ADDR_CHECKPOINT_BLOCK] = copy.deepcopy(
-            {"block_type": BLOCK_TYPE_CHECKPOINT, "entries": self.cr}
+        if self.instrument:
+            start = time.perf_counter()
+        # imap chunks have to be on disk before a checkpoint can point at them
+        self.__flush_imap()
+
+        # only place in code where an OVERWRITE occurs, of the older of the two
+        # checkpoint regions; segment usage table is stored alongside the imap pointers
+        self.checkpoint_timestamp += 1
+        self.checkpoint_address = ADDR_CHECKPOINT_BLOCKS[self.checkpoint_timestamp % 2]
+        self.disk.write(
+            self.checkpoint_address, self.make_checkpoint(), (-1, self.clock, -1, -1)
         )
+        self.checkpoint_serial = self.blocks_written
+        self.checkpoint_clock = self.clock
+        if self.instrument:
+            self.__event(
+                "cr_sync",
+                time.perf_counter() - start,
+                address=self.checkpoint_address,
+                timestamp=self.checkpoint_timestamp,
+            )
         return 0
 
-    def get_inode_from_inumber(self, inode_number):
-        imap_entry_index = int(inode_number / NUM_INODES_PER_IMAP_CHUNK)
-        imap_entry_offset = inode_number % NUM_INODES_PER_IMAP_CHUNK
+    def sync(self):
+        # everything buffered, dirty imap chunks and then a checkpoint
+        self.flush()
+        self.cr_sync()
+        return
 
-        if self.use_disk_cr:
-            # this is the disk path
-            checkpoint_block = self.disk[ADDR_CHECKPOINT_BLOCK]
-            assert checkpoint_block["block_type"] == BLOCK_TYPE_CHECKPOINT
+    def get_inode_from_inumber(self, inode_number):
+        if self.inode_cache.size:
+            inode = self.inode_cache.get(inode_number)
+            if inode is not None:
+                return inode
 
-            imap_block_address = checkpoint_block["entries"][imap_entry_index]
-            imap_block = self.disk[imap_block_address]
-            assert imap_block["block_type"] == BLOCK_TYPE_IMAP
+        imap_entry_index = self.inum_to_chunk(inode_number)
+        imap_entry_offset = inode_number % self.num_inodes_per_imap_chunk
 
-            inode_address = imap_block["entries"][imap_entry_offset]
+        # chunks not yet logged only exist in memory
+        if self.use_disk_cr and imap_entry_index not in self.dirty_chunks:
+            # this is the disk path
+            imap_block = None
+            if self.imap_cache.size:
+                imap_block = self.imap_cache.get(imap_entry_index)
+            if imap_block is None:
+                checkpoint_block = self.disk[self.checkpoint_address]
+                assert checkpoint_block.block_type == BLOCK_TYPE_CHECKPOINT
+
+                if self.num_imap_chunks_per_index:
+                    # two-level imap: checkpoint -> index block -> chunk
+                    index_block = self.disk[
+                        checkpoint_block.entries[
+                            imap_entry_index // self.num_imap_chunks_per_index
+                        ]
+                    ]
+                    assert index_block.block_type == BLOCK_TYPE_IMAP_INDEX
+                    imap_block_address = index_block.entries[
+                        imap_entry_index % self.num_imap_chunks_per_index
+                    ]
+                else:
+                    imap_block_address = checkpoint_block.entries[imap_entry_index]
+                imap_block = self.disk[imap_block_address]
+                assert imap_block.block_type == BLOCK_TYPE_IMAP
+                self.imap_cache.put(imap_entry_index, imap_block)
+
+            inode_address = imap_block.entries[imap_entry_offset]
         else:
             # this is the just-use-the-mem-inode_map path
             inode_address = self.inode_map[inode_number]
 
         assert inode_address != -1
-        inode = self.disk[inode_address]
-        assert inode["block_type"] == BLOCK_TYPE_INODE
+        inode = self.read_block(inode_address)
+        assert inode.block_type == BLOCK_TYPE_INODE
+        self.inode_cache.put(inode_number, inode)
         return inode
 
     def __lookup(self, parent_inode_number, name):
         parent_inode = self.get_inode_from_inumber(parent_inode_number)
-        assert parent_inode["type"] == INODE_DIRECTORY
-        for address in parent_inode["pointers"]:
-            if address == -1:
-                continue
-            directory_block = self.disk[address]
-            assert directory_block["block_type"] == BLOCK_TYPE_DATA_DIRECTORY
-            for entry_name, entry_inode_number in directory_block["entries"]:
-                if entry_name == name:
-                    return (entry_inode_number, parent_inode)
-        return (-1, parent_inode)
+        assert parent_inode.type == INODE_DIRECTORY
+        entry_inode_number = self.dentry_cache.get((parent_inode_number, name), -1)
+        if entry_inode_number != -1:
+            self.dentry_hits += 1
+            return (entry_inode_number, parent_inode)
+        self.dentry_misses += 1
+        inode_index, slot_index = self.__find_matching_dir_slot(name, parent_inode)
+        if inode_index == -1:
+            return (-1, parent_inode)
+        directory_block = self.__read_dirblock(parent_inode, inode_index)
+        entry_inode_number = directory_block.entries[slot_index][1]
+        self.dentry_cache[(parent_inode_number, name)] = entry_inode_number
+        return (entry_inode_number, parent_inode)
 
     def __walk_path(self, path):
+        if not self.instrument:
+            return self.__resolve_path(path)
+        start = time.perf_counter()
+        dirblocks_read = self.dirblocks_read
+        path_lookups = self.path_lookups
+        result = self.__resolve_path(path)
+        components = self.path_lookups - path_lookups
+        dirblocks = self.dirblocks_read - dirblocks_read
+        self.__count("walk_path.components", components)
+        self.__count("walk_path.dirblocks", dirblocks)
+        self.__event(
+            "walk_path",
+            time.perf_counter() - start,
+            path=path,
+            components=components,
+            dirblocks=dirblocks,
+        )
+        return result
+
+    def __resolve_path(self, path):
         split_path = path.split("/")
         if split_path[0] != "":
             self.error_log("path malformed: must start with /")
@@ -383,11 +2152,13 @@ class LFS:
         inode_number = -1
         parent_inode_number = ROOT_INODE  # root inode number is well known
         for i in range(1, len(split_path) - 1):
+            self.path_lookups += 1
             inode_number, inode = self.__lookup(parent_inode_number, split_path[i])
             if inode_number == -1:
                 self.error_log("directory %s not found" % split_path[i])
                 return -1, "", -1, ""
-            if inode["type"] != INODE_DIRECTORY:
+            inode = self.get_inode_from_inumber(inode_number)
+            if inode.type != INODE_DIRECTORY:
                 self.error_log(
                     "invalid element of path [%s] (not a dir)" % split_path[i]
                 )
@@ -395,58 +2166,202 @@ class LFS:
             parent_inode_number = inode_number
 
         file_name = split_path[len(split_path) - 1]
+        self.path_lookups += 1
         inode_number, parent_inode = self.__lookup(parent_inode_number, file_name)
         return inode_number, file_name, parent_inode_number, parent_inode
 
     def update_imap(self, inum_list):
-        chunk_list = list()
+        if self.instrument:
+            start = time.perf_counter()
+            blocks_written = self.blocks_written
         for inum in inum_list:
-            cnum = self.inum_to_chunk(inum)
-            if cnum not in chunk_list:
-                chunk_list.append(cnum)
-                self.log(self.make_imap_chunk(cnum))
-                self.cr[cnum] = len(self.disk) - 1
+            self.dirty_chunks.add(self.inum_to_chunk(inum))
+        # with buffering on, dirty chunks wait for the next flush, with
+        # deferred checkpoints for the next checkpoint, and in a group commit
+        # for the end of the group
+        if (
+            not self.write_buffer_size
+            and self.checkpoint_policy == CHECKPOINT_EVERY_OP
+            and not self.group_depth
+        ):
+            self.__flush_imap()
+        if self.instrument:
+            self.__event(
+                "update_imap",
+                time.perf_counter() - start,
+                inodes=len(inum_list),
+                chunks_written=self.blocks_written - blocks_written,
+            )
+        return
+
+    @contextlib.contextmanager
+    def group_commit(self):
+        # operations run inside share one imap update and checkpoint, done as
+        # if a single operation ended when the (outermost) group does
+        self.group_depth += 1
+        try:
+            yield self
+        finally:
+            self.group_depth -= 1
+            if self.group_depth == 0:
+                self.__commit()
+
+    def __commit(self):
+        if self.group_depth:
+            return
+        # end of an operation: flush a full buffer, or sync the checkpoint region
+        if self.write_buffer_size:
+            if len(self.buffer) >= self.write_buffer_size:
+                self.flush()
+        elif (
+            self.checkpoint_policy == CHECKPOINT_EVERY_OP
+            and not self.no_force_checkpoints
+        ):
+            self.cr_sync()
+
+        # deferred checkpoints, once enough operations or blocks have gone by
+        if self.checkpoint_policy == CHECKPOINT_OPS:
+            if self.clock - self.checkpoint_clock >= self.checkpoint_interval:
+                self.sync()
+        elif self.checkpoint_policy == CHECKPOINT_BLOCKS:
+            if self.blocks_written - self.checkpoint_serial >= self.checkpoint_interval:
+                self.sync()
         return
 
     def __read_dirblock(self, inode, index):
-        return self.disk[inode["pointers"][index]]
+        self.dirblocks_read += 1
+        directory_block = self.read_block(self.bmap(inode, index))
+        assert directory_block.block_type == BLOCK_TYPE_DATA_DIRECTORY
+        return directory_block
+
+    def __dir_bucket(self, name, size):
+        # linear hashing: the number of buckets alone says how far the table
+        # has been split, buckets below size - 2^level already use one more bit
+        h = zlib.crc32(name.encode())
+        low = 1 << (size.bit_length() - 1)
+        bucket = h % low
+        if bucket < size - low:
+            bucket = h % (low * 2)
+        return bucket
+
+    def __dir_probe(self, name, size):
+        # buckets a name may be in: only its own, unless the directory is too
+        # big to split, where a full bucket overflows into the ones after it
+        bucket = self.__dir_bucket(name, size)
+        if size < self.max_file_blocks:
+            return [bucket]
+        return [(bucket + i) % size for i in range(size)]
 
     # return (inode_index, dirblock_index)
     def __find_matching_dir_slot(self, name, inode):
-        for inode_index in range(inode["size"]):
+        if self.dir_layout == DIR_HASHED:
+            inode_indexes = self.__dir_probe(name, inode.size)
+        else:
+            inode_indexes = range(inode.size)
+        for inode_index in inode_indexes:
             directory_block = self.__read_dirblock(inode, inode_index)
-            assert directory_block["block_type"] == BLOCK_TYPE_DATA_DIRECTORY
-
-            for slot_index in range(len(directory_block["entries"])):
-                entry_name, entry_inode_number = directory_block["entries"][slot_index]
+            never_used = False
+            for slot_index in range(len(directory_block.entries)):
+                entry_name, entry_inode_number = directory_block.entries[slot_index]
                 if entry_name == name:
                     return inode_index, slot_index
+                if entry_inode_number == -1:
+                    never_used = True
+            if never_used and self.dir_layout == DIR_HASHED:
+                # nothing would have overflowed past a bucket with room left
+                break
         return -1, -1
 
-    def __add_dir_entry(self, parent_inode, file_name, inode_number):
+    def __find_free_dir_slot(self, parent_inode_number, inode):
+        # dirblocks before the hint are known to be full
+        start = self.dir_free_hint.get(parent_inode_number, 0)
+        for inode_index in range(start, inode.size):
+            directory_block = self.__read_dirblock(inode, inode_index)
+            for slot_index in range(len(directory_block.entries)):
+                if directory_block.entries[slot_index][1] == -1:
+                    self.dir_free_hint[parent_inode_number] = inode_index
+                    return inode_index, slot_index
+        self.dir_free_hint[parent_inode_number] = inode.size
+        return -1, -1
+
+    def __split_dir_bucket(self, parent_inode, new_directory_blocks, size):
+        # split the next bucket in line: its entries either stay, or move to
+        # the new bucket at the end of the directory
+        low = 1 << (size.bit_length() - 1)
+        bucket = size - low
+        directory_block = new_directory_blocks.get(bucket)
+        if directory_block is None:
+            directory_block = self.__read_dirblock(parent_inode, bucket)
+        split_blocks = {bucket: self.make_empty_dirblock()}
+        split_blocks[size] = self.make_empty_dirblock()
+        used = {bucket: 0, size: 0}
+        for entry in directory_block.entries:
+            if entry[1] < 0:
+                continue
+            index = self.__dir_bucket(entry[0], size + 1)
+            split_blocks[index].entries[used[index]] = entry
+            used[index] += 1
+        new_directory_blocks.update(split_blocks)
+        return
+
+    def __add_hashed_dir_entry(self, parent_inode, file_name, inode_number):
+        # returns the new directory size and {dirblock index: new dirblock}
+        new_directory_blocks = {}
+        size = parent_inode.size
+        while True:
+            for index in self.__dir_probe(file_name, size):
+                directory_block = new_directory_blocks.get(index)
+                if directory_block is None:
+                    directory_block = self.__read_dirblock(parent_inode, index).copy()
+                for slot_index in range(len(directory_block.entries)):
+                    if directory_block.entries[slot_index][1] < 0:
+                        directory_block.entries[slot_index] = (file_name, inode_number)
+                        new_directory_blocks[index] = directory_block
+                        return size, new_directory_blocks
+            # bucket is full: split buckets until there is room in this one
+            if size == self.max_file_blocks:
+                return -1, {}
+            self.__split_dir_bucket(parent_inode, new_directory_blocks, size)
+            size += 1
+
+    def __add_dir_entry(
+        self, parent_inode_number, parent_inode, file_name, inode_number
+    ):
+        if self.dir_layout == DIR_HASHED:
+            parent_size, new_directory_blocks = self.__add_hashed_dir_entry(
+                parent_inode, file_name, inode_number
+            )
+            if parent_size == -1:
+                return -1, {}
+            self.dentry_cache[(parent_inode_number, file_name)] = inode_number
+            return parent_size, new_directory_blocks
+
         # this will be the directory block to contain the new name->inum mapping
-        inode_index, dirblock_index = self.__find_matching_dir_slot("-", parent_inode)
+        inode_index, dirblock_index = self.__find_free_dir_slot(
+            parent_inode_number, parent_inode
+        )
 
         if inode_index != -1:
             # there is room in existing block: make copy, update it, and log it
             index_to_update = inode_index
-            parent_size = parent_inode["size"]
+            parent_size = parent_inode.size
 
-            new_directory_block = copy.deepcopy(
-                self.__read_dirblock(parent_inode, inode_index)
-            )
-            new_directory_block["entries"][dirblock_index] = (file_name, inode_number)
+            new_directory_block = self.__read_dirblock(parent_inode, inode_index).copy()
+            new_directory_block.entries[dirblock_index] = (file_name, inode_number)
         else:
             # no room in existing directory block: allocate new one IF there is room in inode to point to it
-            if parent_inode["size"] != NUM_INODE_PTRS:
-                index_to_update = parent_inode["size"]
+            if parent_inode.size != self.max_file_blocks:
+                index_to_update = parent_inode.size
                 parent_size = index_to_update + 1
 
                 new_directory_block = self.make_empty_dirblock()
-                new_directory_block["entries"][0] = (file_name, inode_number)
+                new_directory_block.entries[0] = (file_name, inode_number)
             else:
-                return -1, -1, {}
-        return index_to_update, parent_size, new_directory_block
+                return -1, {}
+
+        # the directory now has this name, so the dentry cache can have it too
+        self.dentry_cache[(parent_inode_number, file_name)] = inode_number
+        return parent_size, {index_to_update: new_directory_block}
 
     # create (file OR dir)
     def __file_create(self, path, is_file):
@@ -463,35 +2378,46 @@ class LFS:
             return -1
 
         # finally, allocate inode number for new file/dir
-        new_inode_number = self.allocate_inode()
+        new_inode_number = self.allocate_inode(parent_inode_number)
         if new_inode_number == -1:
             self.error_log("create failed: no more inodes available")
             return -1
 
-        # this will be the directory block to contain the new name->inum mapping
-        index_to_update, parent_size, new_directory_block = self.__add_dir_entry(
-            parent_inode, file_name, new_inode_number
+        # these will be the directory block(s) to contain the new name->inum mapping
+        parent_size, new_directory_blocks = self.__add_dir_entry(
+            parent_inode_number, parent_inode, file_name, new_inode_number
         )
-        if index_to_update == -1:
+        if parent_size == -1:
             self.error_log("error: directory is full (path %s)" % path)
             self.free_inode(new_inode_number)
             return -1
 
-        # log directory data block (either new version of old OR new one entirely)
-        new_directory_block_address = self.log(new_directory_block)
+        # log directory data block(s) (either new version of old OR new one entirely)
+        new_directory_block_addresses = {}
+        for index in sorted(new_directory_blocks):
+            new_directory_block_addresses[index] = self.log(
+                new_directory_blocks[index], (parent_inode_number, index)
+            )
 
         # now have to make new version of directory inode
         # update size (if needed), inc refs if this is a dir, point to new dir block addr
-        new_parent_inode = copy.deepcopy(parent_inode)
-        new_parent_inode["size"] = parent_size
+        new_parent_inode = parent_inode.copy()
+        new_parent_inode.size = parent_size
         if not is_file:
-            new_parent_inode["refs"] += 1
-        new_parent_inode["pointers"][index_to_update] = new_directory_block_address
+            new_parent_inode.refs += 1
+        self.__set_pointers(
+            parent_inode_number,
+            new_parent_inode,
+            new_directory_block_addresses,
+            self.log,
+        )
 
         # if directory, must create empty dir block
         if not is_file:
-            self.log(self.make_new_dirblock(parent_inode_number, new_inode_number))
-            new_dirblock_address = len(self.disk) - 1
+            new_dirblock_address = self.log(
+                self.make_new_dirblock(parent_inode_number, new_inode_number),
+                (new_inode_number, 0),
+            )
 
         # and the new inode itself
         if is_file:
@@ -500,13 +2426,13 @@ class LFS:
         else:
             # create directory inode and point it to the one dirblock it owns
             new_inode = self.make_inode(itype=INODE_DIRECTORY, size=1, refs=2)
-            new_inode["pointers"][0] = new_dirblock_address
+            new_inode.pointers[0] = new_dirblock_address
 
         #
         # ADD updated parent inode, file/dir inode TO LOG
         #
-        new_parent_inode_address = self.log(new_parent_inode)
-        new_inode_address = self.log(new_inode)
+        new_parent_inode_address = self.log(new_parent_inode, (parent_inode_number, -1))
+        new_inode_address = self.log(new_inode, (new_inode_number, -1))
 
         # and new imap entries for both parent and new inode
         self.remap(parent_inode_number, new_parent_inode_address)
@@ -516,34 +2442,53 @@ class LFS:
         self.update_imap([parent_inode_number, new_inode_number])
 
         # SYNC checkpoint region
-        if not self.no_force_checkpoints:
-            self.cr_sync()
+        self.__commit()
         return 0
 
     def _space_check(self):
-        if len(self.disk) > NUM_BLOCKS * GC_THRESHOLD:
-            print(f"Used {len(self.disk)} blocks now, triggering garbage collection...")
-            self.gc()
+        if self.blocks_in_use() > self.num_blocks * self.gc_threshold:
+            if self.instrument:
+                self.__event("space_check", blocks_in_use=self.blocks_in_use())
+            print(
+                f"Used {self.blocks_in_use()} blocks now, triggering garbage collection..."
+            )
+            self.clean()
+        elif (
+            self.clean_budget
+            and self.clean_policy != CLEAN_COMPACT
+            and self.blocks_in_use() > self.num_blocks * CLEAN_LOW_WATERMARK
+            and self.blocks_written - self.clean_step_written >= self.clean_budget
+            and len(self.buffer) == 0
+        ):
+            # a step at a time, paced by what has been written since the
+            # last one, and between write buffer flushes
+            self.clean(self.clean_budget)
+            self.clean_step_written = self.blocks_written
 
     # file_create()
     def file_create(self, path):
         self.error_clear()
+        self.clock += 1
         self._space_check()
         return self.__file_create(path, True)
 
     # dir_create()
     def dir_create(self, path):
         self.error_clear()
+        self.clock += 1
         self._space_check()
         return self.__file_create(path, False)
 
-    def file_write(self, path, offset, num_blks):
+    def file_write(self, path, offset, num_blks, contents=None):
         self.error_clear()
+        self.clock += 1
         self._space_check()
 
         # just make up contents of data blocks - up to the max spec'd by write
+        # (unless given, e.g. to have the same data written twice)
         # note: may not write all of these, because of running out of room in inode...
-        contents = self.make_random_blocks(num_blks)
+        if contents is None:
+            contents = self.make_random_blocks(num_blks)
 
         inode_number, file_name, parent_inode_number, parent_inode = self.__walk_path(
             path
@@ -553,50 +2498,64 @@ class LFS:
             return -1
 
         inode = self.get_inode_from_inumber(inode_number)
-        if inode["type"] != INODE_REGULAR:
+        if inode.type != INODE_REGULAR:
             self.error_log("write failed: cannot write to non-regular file %s" % path)
             return -1
 
-        if offset < 0 or offset >= NUM_INODE_PTRS:
+        if offset < 0 or offset >= self.max_file_blocks:
             self.error_log("write failed: bad offset %d" % offset)
             return -1
 
-        # create potential write list -- up to max file size
-        current_log_ptr = len(self.disk)
+        # a file written again soon after the last time is hot
+        if self.hot_age:
+            last_write = self.last_write.get(inode_number)
+            if last_write is not None and self.clock - last_write <= self.hot_age:
+                self.hot_files.add(inode_number)
+            else:
+                self.hot_files.discard(inode_number)
+            self.last_write[inode_number] = self.clock
+
+        # write data block(s) -- up to max file size
+        new_inode = inode.copy()
         current_offset = offset
-        potential_writes = []
-        while current_offset < NUM_INODE_PTRS and current_offset < offset + len(
+        updates = {}
+        while current_offset < self.max_file_blocks and current_offset < offset + len(
             contents
         ):
-            potential_writes.append((current_offset, current_log_ptr))
+            block = self.make_data_block(contents[current_offset - offset])
+            address = -1
+            if self.dedup:
+                address = self.fingerprints.get(self.fingerprint(block.contents), -1)
+            if address != -1:
+                # already on disk: share that block instead
+                assert self.live[address]
+                self.dedup_hits += 1
+            else:
+                address = self.log(block, (inode_number, current_offset))
+            if self.dedup and address < ADDR_BUFFER_BASE:
+                self.__add_ref(address, block, inode_number, current_offset)
+            updates[current_offset] = address
             current_offset += 1
-            current_log_ptr += 1
-
-        # write data block(s)
-        for i in range(len(potential_writes)):
-            self.log(self.make_data_block(contents[i]))
+        # then the indirect blocks on the way to them
+        self.__set_pointers(inode_number, new_inode, updates, self.log)
 
         # write new version of inode, with updated size
-        new_inode = copy.deepcopy(inode)
-        new_inode["size"] = max(current_offset, inode["size"])
-        for new_offset, new_addr in potential_writes:
-            new_inode["pointers"][new_offset] = new_addr
-        new_inode_address = self.log(new_inode)
+        new_inode.size = max(current_offset, inode.size)
+        new_inode_address = self.log(new_inode, (inode_number, -1))
 
         # write new chunk of imap
         self.remap(inode_number, new_inode_address)
-        self.log(self.make_imap_chunk(self.inum_to_chunk(inode_number)))
-        self.cr[self.inum_to_chunk(inode_number)] = len(self.disk) - 1
+        self.update_imap([inode_number])
 
         # write checkpoint region
-        if not self.no_force_checkpoints:
-            self.cr_sync()
+        self.__commit()
 
         # return size of write (total # written, not desired, may be less than asked for)
         return current_offset - offset
 
     def file_delete(self, path):
         self.error_clear()
+        self.clock += 1
         self._space_check()
 
         inode_number, file_name, parent_inode_number, parent_inode = self.__walk_path(
@@ -607,12 +2566,12 @@ class LFS:
             return -1
 
         inode = self.get_inode_from_inumber(inode_number)
-        if inode["type"] != INODE_REGULAR:
+        if inode.type != INODE_REGULAR:
             self.error_log("delete failed: cannot delete non-regular file [%s]" % path)
             return -1
 
         # have to check: is the file actually down to its last ref?
-        if inode["refs"] == 1:
+        if inode.refs == 1:
             self.free_inode(inode_number)
 
         # now, find entry in DIRECTORY DATA BLOCK and zero it
@@ -620,83 +2579,350 @@ class LFS:
             file_name, parent_inode
         )
         assert inode_index != -1
-        new_directory_block = copy.deepcopy(
-            self.__read_dirblock(parent_inode, inode_index)
-        )
-        new_directory_block["entries"][dirblock_index] = ("-", -1)
+        new_directory_block = self.__read_dirblock(parent_inode, inode_index).copy()
+        if self.dir_layout == DIR_HASHED and parent_inode.size == self.max_file_blocks:
+            new_directory_block.entries[dirblock_index] = ("-", DIRENT_REMOVED)
+        else:
+            new_directory_block.entries[dirblock_index] = ("-", -1)
+        self.dentry_cache.pop((parent_inode_number, file_name), None)
+        if inode_index < self.dir_free_hint.get(parent_inode_number, 0):
+            self.dir_free_hint[parent_inode_number] = inode_index
 
         # this leads to DIRECTORY DATA, DIR INODE, (and hence IMAP_CHUNK, CR_SYNC) writes
-        dir_addr = self.log(new_directory_block)
+        dir_addr = self.log(new_directory_block, (parent_inode_number, inode_index))
 
-        new_parent_inode = copy.deepcopy(parent_inode)
-        new_parent_inode["pointers"][inode_index] = dir_addr
-        new_parent_inode_addr = self.log(new_parent_inode)
+        new_parent_inode = parent_inode.copy()
+        self.__set_pointers(
+            parent_inode_number, new_parent_inode, {inode_index: dir_addr}, self.log
+        )
+        new_parent_inode_addr = self.log(new_parent_inode, (parent_inode_number, -1))
         self.remap(parent_inode_number, new_parent_inode_addr)
 
         # if this ISNT the last link, decrease ref count and output new version
-        if inode["refs"] > 1:
-            new_inode = copy.deepcopy(inode)
-            new_inode["refs"] -= 1
-            new_inode_addr = self.log(new_inode)
+        if inode.refs > 1:
+            new_inode = inode.copy()
+            new_inode.refs -= 1
+            new_inode_addr = self.log(new_inode, (inode_number, -1))
             self.remap(inode_number, new_inode_addr)
 
         # create new chunk of imap
         self.update_imap([inode_number, parent_inode_number])
 
         # and sync if need be
-        if not self.no_force_checkpoints:
-            self.cr_sync()
+        self.__commit()
         return 0
 
+    def file_read(self, path, offset, num_blks):
+        self.error_clear()
+
+        inode_number, file_name, parent_inode_number, parent_inode = self.__walk_path(
+            path
+        )
+        if inode_number == -1:
+            self.error_log("read failed: file not found [path %s]" % path)
+            return -1
+
+        inode = self.get_inode_from_inumber(inode_number)
+        if inode.type != INODE_REGULAR:
+            self.error_log("read failed: cannot read non-regular file %s" % path)
+            return -1
+
+        if offset < 0 or offset >= self.max_file_blocks:
+            self.error_log("read failed: bad offset %d" % offset)
+            return -1
+
+        # contents of the blocks up to the end of the file (None for a hole)
+        contents = []
+        previous = -1
+        for block_number in range(offset, min(offset + num_blks, inode.size)):
+            address = self.bmap(inode, block_number)
+            if address == -1:
+                contents.append(None)
+                continue
+            contents.append(self.__read_file_block(address).contents)
+            if address < ADDR_BUFFER_BASE:
+                if previous != -1:
+                    self.read_stats["distance"] += abs(address - previous)
+                    self.read_stats["pairs"] += 1
+                previous = address
+        return contents
+
+    def __read_file_block(self, address):
+        self.read_stats["blocks"] += 1
+        if address >= ADDR_BUFFER_BASE:
+            return self.buffer[address - ADDR_BUFFER_BASE]
+        if self.read_cache.size:
+            block = self.read_cache.get(address)
+            if block is not None:
+                return block
+        self.read_stats["fetches"] += 1
+        block = self.disk[address]
+        self.read_cache.put(address, block)
+
+        # the rest of a sequential run is likely to be in the same segment
+        if self.readahead:
+            segment = self.segment_addresses(self.address_to_segment(address))
+            for next_address in range(
+                address + 1, min(address + 1 + self.readahead, segment.stop)
+            ):
+                if next_address not in self.read_cache.entries:
+                    self.read_cache.put(next_address, self.disk[next_address])
+        return block
+
+    def dedup_ratio(self):
+        # file blocks per data block they share, over deduplicated blocks on disk
+        if len(self.block_refs) == 0:
+            return 1.0
+        return sum(len(refs) for refs in self.block_refs.values()) / len(
+            self.block_refs
+        )
+
+    def dedup_index_size(self):
+        # bytes of memory the dedup index takes up
+        size = sys.getsizeof(self.fingerprints) + sys.getsizeof(self.block_refs)
+        for key in self.fingerprints:
+            size += sys.getsizeof(key)
+        for refs in self.block_refs.values():
+            size += sys.getsizeof(refs)
+            for ref in refs:
+                size += sys.getsizeof(ref)
+        return size
+
+    def read_locality(self):
+        # average log distance between consecutive blocks of a file read
+        if self.read_stats["pairs"] == 0:
+            return 0
+        return self.read_stats["distance"] / self.read_stats["pairs"]
+
+    def stat(self, path):
+        # inode of a file or directory, without logging anything
+        self.error_clear()
+        inode_number, file_name, parent_inode_number, parent_inode = self.__walk_path(
+            path
+        )
+        if inode_number == -1:
+            self.error_log("stat failed: not found [%s]" % path)
+            return -1
+        return self.get_inode_from_inumber(inode_number)
+
+
+class GroupCommitLFS:
+    # thread-safe front end: any number of client threads submit operations,
+    # and a single log writer thread runs whatever is pending as one batch
+    # inside group_commit(), so a batch costs one imap update and checkpoint
+    def __init__(self, L, max_batch=0):
+        self.L = L
+        # held by the log writer for one operation (or the batch's commit) at
+        # a time, and by readers for one lookup, so a read waits for at most
+        # one operation rather than a whole batch
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        # most operations in one batch (0 for no limit)
+        self.max_batch = max_batch
+        self.batches = 0
+        self.ops = 0
+        self.writer = threading.Thread(target=self.__log_writer, daemon=True)
+        self.writer.start()
+
+    def __log_writer(self):
+        while True:
+            batch = [self.requests.get()]
+            while self.max_batch == 0 or len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            group = contextlib.ExitStack()
+            with self.lock:
+                group.enter_context(self.L.group_commit())
+            results = []
+            for request in batch:
+                if request is None:
+                    continue
+                command, future = request
+                with self.lock:
+                    try:
+                        results.append((future, execute_command(self.L, command), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+            # clients only hear back once the batch is committed
+            error = None
+            with self.lock:
+                try:
+                    group.close()
+                except Exception as e:
+                    error = e
+            for future, result, exception in results:
+                if error is not None or exception is not None:
+                    future.set_exception(exception or error)
+                else:
+                    future.set_result(result)
+            self.batches += 1
+            self.ops += len([request for request in batch if request is not None])
+            if None in batch:
+                return
+
+    def submit(self, command):
+        # queue a command ("c,/path" etc.), returns a Future of its result
+        future = Future()
+        self.requests.put((command, future))
+        return future
+
+    def file_create(self, path):
+        return self.submit("c,%s" % path).result()
+
+    def dir_create(self, path):
+        return self.submit("d,%s" % path).result()
+
+    def file_write(self, path, offset, num_blks):
+        return self.submit("w,%s,%d,%d" % (path, offset, num_blks)).result()
+
+    def file_delete(self, path):
+        return self.submit("r,%s" % path).result()
+
+    def stat(self, path):
+        # reads skip the queue, and only wait for the batch in progress
+        with self.lock:
+            return self.L.stat(path)
+
+    def close(self):
+        # run what is still queued, then stop the log writer
+        self.requests.put(None)
+        self.writer.join()
+        return
+
+
+class AsyncLFS:
+    # asyncio front end: operations run on the event loop, and all those
+    # issued while a group is open are committed together, so thousands of
+    # client coroutines share log appends without a thread each
+    def __init__(self, L, executor=None):
+        self.L = L
+        # where blocking work goes (None for the loop's default executor)
+        self.executor = executor
+        # held while an operation or a commit runs
+        self.lock = asyncio.Lock()
+        # the open group: its exit stack, and a future done once committed
+        self.group = None
+        self.group_exit = None
+        self.commit_task = None
+        self.commits = 0
+        self.ops = 0
+
+    def __blocking(self):
+        # a file-backed disk, or a blocking clean coming up
+        return (
+            not isinstance(self.L.disk, MemoryDisk)
+            or self.L.blocks_in_use() > self.L.num_blocks * self.L.gc_threshold
+        )
+
+    async def __call(self, function, *args):
+        if self.__blocking():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, function, *args)
+        return function(*args)
+
+    async def __operation(self, function, *args):
+        async with self.lock:
+            if self.group is None:
+                self.group = asyncio.get_running_loop().create_future()
+                self.group_exit = contextlib.ExitStack()
+                self.group_exit.enter_context(self.L.group_commit())
+                self.commit_task = asyncio.ensure_future(self.__commit())
+            result = await self.__call(function, *args)
+            self.ops += 1
+            group = self.group
+        # wait for the one commit shared by everything in the group
+        await asyncio.shield(group)
+        return result
+
+    async def __commit(self):
+        # clients that are ready to run get to join the group first
+        await asyncio.sleep(0)
+        async with self.lock:
+            group, group_exit = self.group, self.group_exit
+            self.group = None
+            try:
+                await self.__call(group_exit.close)
+            except Exception as e:
+                group.set_exception(e)
+            else:
+                group.set_result(None)
+            self.commits += 1
+
+    async def file_create(self, path):
+        return await self.__operation(self.L.file_create, path)
+
+    async def dir_create(self, path):
+        return await self.__operation(self.L.dir_create, path)
+
+    async def file_write(self, path, offset, num_blks):
+        return await self.__operation(self.L.file_write, path, offset, num_blks)
+
+    async def file_delete(self, path):
+        return await self.__operation(self.L.file_delete, path)
 
-def pick_random(a_list):
+    async def file_read(self, path, offset, num_blks):
+        # reads log nothing, so there is nothing to commit
+        async with self.lock:
+            return await self.__call(self.L.file_read, path, offset, num_blks)
+
+    async def execute(self, command):
+        # same commands as execute_command()
+        op, args = parse_command(command)
+        if op not in COMMAND_METHODS:
+            return -1
+        return await getattr(self, COMMAND_METHODS[op])(*args)
+
+
+def pick_random(a_list, rng=random):
     if len(a_list) == 0:
         return ""
-    index = int(random.random() * len(a_list))
+    index = int(rng.random() * len(a_list))
     return a_list[index]
 
 
-def make_random_file_name(parent_dir):
-    L1 = chr(ord("a") + int(random.random() * 26))
-    L2 = chr(ord("a") + int(random.random() * 26))
-    N1 = str(int(random.random() * 10))
+def make_random_file_name(parent_dir, rng=random):
+    L1 = chr(ord("a") + int(rng.random() * 26))
+    L2 = chr(ord("a") + int(rng.random() * 26))
+    N1 = str(int(rng.random() * 10))
     if parent_dir == "/":
         return "/" + L1 + L2 + N1
     return parent_dir + "/" + L1 + L2 + N1
 
 
-def make_commands(num_commands, percents):
+def make_commands(num_commands, percents, rng=random):
     commands = []
     existing_files = []
     existing_dirs = ["/"]
     while num_commands > 0:
-        chances = random.random()
+        chances = rng.random()
         command = ""
         if chances >= percents["c"][0] and chances < percents["c"][1]:
-            pdir = pick_random(existing_dirs)
+            pdir = pick_random(existing_dirs, rng)
             if pdir == "":
                 continue
-            nfile = make_random_file_name(pdir)
+            nfile = make_random_file_name(pdir, rng)
             command = "c,%s" % nfile
             existing_files.append(nfile)
         elif chances >= percents["w"][0] and chances < percents["w"][1]:
-            pfile = pick_random(existing_files)
+            pfile = pick_random(existing_files, rng)
             if pfile == "":
                 continue
-            woff = int(random.random() * 8)
-            wlen = int(random.random() * 8)
+            woff = int(rng.random() * 8)
+            wlen = int(rng.random() * 8)
             command = "w,%s,%d,%d" % (pfile, woff, wlen)
         elif chances >= percents["d"][0] and chances < percents["d"][1]:
-            pdir = pick_random(existing_dirs)
+            pdir = pick_random(existing_dirs, rng)
             if pdir == "":
                 continue
-            ndir = make_random_file_name(pdir)
+            ndir = make_random_file_name(pdir, rng)
             command = "d,%s" % ndir
             existing_dirs.append(ndir)
         elif chances >= percents["r"][0] and chances < percents["r"][1]:
             if len(existing_files) == 0:
                 continue
-            index = int(random.random() * len(existing_files))
+            index = int(rng.random() * len(existing_files))
             command = "r,%s" % existing_files[index]
             del existing_files[index]
         else:
@@ -707,46 +2933,328 @@ def make_commands(num_commands, percents):
     return commands
 
 
-def parse_and_execute(commands):
-    L = LFS()
+def make_skewed_commands(
+    num_files,
+    num_writes,
+    hot_files=0.1,
+    hot_writes=0.9,
+    file_blocks=NUM_INODE_PTRS,
+    rng=random,
+):
+    # create and fill num_files files, then rewrite single blocks, sending
+    # hot_writes of the writes to the first hot_files of the files
+    commands = []
+    for i in range(num_files):
+        commands.append("c,/f%d" % i)
+        commands.append("w,/f%d,0,%d" % (i, file_blocks))
+    num_hot = max(1, int(num_files * hot_files))
+    for i in range(num_writes):
+        if rng.random() < hot_writes:
+            file_number = int(rng.random() * num_hot)
+        else:
+            file_number = num_hot + int(rng.random() * (num_files - num_hot))
+        offset = int(rng.random() * file_blocks)
+        commands.append("w,/f%d,%d,1" % (file_number, offset))
+    return commands
+
+
+def generate_commands(
+    num_commands,
+    percents=None,
+    seed=0,
+    popularity=POPULARITY_UNIFORM,
+    zipf_s=1.0,
+    hot_files=0.1,
+    hot_writes=0.9,
+    write_sizes=(1,) * 8,
+    offsets=(1,) * 8,
+    depths=(1,),
+    batch_size=1 << 14,
+    parsed=False,
+):
+    # same kind of commands as make_commands(), streamed out as they are made,
+    # with random numbers drawn a batch at a time (with numpy if available);
+    # write_sizes, offsets and depths are relative weights of 0, 1, 2, ...
+    # blocks written, offset and depth of the directory new files and
+    # directories go in; the same seed gives the same commands
+    if percents is None:
+        percents = COMMAND_MIX
+    ops = list(percents)
+    op_weights = [percents[op][1] - percents[op][0] for op in ops]
+
+    if numpy is not None:
+        rng = numpy.random.default_rng(seed)
+
+        def chooser(weights):
+            p = numpy.asarray(weights, dtype=float)
+            p /= p.sum()
+            return lambda n: rng.choice(len(p), size=n, p=p).tolist()
+
+        def uniforms(n):
+            return rng.random(n).tolist()
+
+    else:
+        rng = random.Random(seed)
+
+        def words(n, code):
+            # n random unsigned ints out of a single getrandbits() call
+            size = struct.calcsize(code)
+            data = rng.getrandbits(8 * size * n).to_bytes(size * n, sys.byteorder)
+            return memoryview(data).cast(code)
+
+        def chooser(weights):
+            # a table with an entry per 16-bit value, so each pick is one lookup
+            total = sum(weights)
+            bounds = []
+            for weight in weights:
+                bounds.append((bounds[-1] if bounds else 0) + weight / total)
+            table = [
+                min(bisect.bisect_right(bounds, (j + 0.5) / 65536), len(weights) - 1)
+                for j in range(65536)
+            ]
+            return lambda n: [table[x] for x in words(n, "H")]
+
+        def uniforms(n):
+            return [x / 4294967296 for x in words(n, "I")]
+
+    choose_op = chooser(op_weights)
+    choose_size = chooser(write_sizes)
+    choose_offset = chooser(offsets)
+    choose_depth = chooser(depths)
+
+    # files in creation order, except that a deleted one is replaced by the
+    # newest, so deletes are O(1); directories by depth
+    files = []
+    dirs = [["/"]]
+    names = 0
+    while num_commands > 0:
+        n = min(batch_size, num_commands)
+        batch_ops = choose_op(n)
+        targets = uniforms(n)
+        batch_sizes = choose_size(n)
+        batch_offsets = choose_offset(n)
+        batch_depths = choose_depth(n)
+        for i in range(n):
+            op = ops[batch_ops[i]]
+            u = targets[i]
+            if op == "c" or op == "d":
+                depth = min(batch_depths[i], len(dirs) - 1)
+                parent = dirs[depth][int(u * len(dirs[depth]))]
+                names += 1
+                path = "%s/%s%d" % (
+                    "" if parent == "/" else parent,
+                    "f" if op == "c" else "d",
+                    names,
+                )
+                if op == "c":
+                    files.append(path)
+                else:
+                    if depth + 1 == len(dirs):
+                        dirs.append([])
+                    dirs[depth + 1].append(path)
+                args = (path,)
+            elif len(files) == 0:
+                continue
+            elif op == "r":
+                index = int(u * len(files))
+                args = (files[index],)
+                files[index] = files[-1]
+                files.pop()
+            else:
+                num_files = len(files)
+                if popularity == POPULARITY_ZIPF:
+                    # inverse of the (continuous) cdf of 1 / k ** zipf_s
+                    if zipf_s == 1:
+                        k = num_files**u
+                    else:
+                        k = ((num_files ** (1 - zipf_s) - 1) * u + 1) ** (
+                            1 / (1 - zipf_s)
+                        )
+                    index = min(int(k) - 1, num_files - 1)
+                elif popularity == POPULARITY_HOT_COLD:
+                    num_hot = max(1, int(num_files * hot_files))
+                    if num_hot == num_files:
+                        # every file is hot
+                        index = int(u * num_files)
+                    elif u < hot_writes:
+                        index = int(u / hot_writes * num_hot) % num_hot
+                    else:
+                        v = (u - hot_writes) / (1 - hot_writes)
+                        index = num_hot + int(v * (num_files - num_hot))
+                else:
+                    index = int(u * num_files)
+                args = (files[index], batch_offsets[i], batch_sizes[i])
+            num_commands -= 1
+            if parsed:
+                yield op, args
+            else:
+                yield ",".join([op] + [str(arg) for arg in args])
+        # a batch can come up short of commands, by writes and deletes
+        # drawn with no files around yet
+    return
+
+
+def execute_command(L, command):
+    op, args = parse_command(command)
+    if op not in COMMAND_METHODS:
+        return -1
+    return getattr(L, COMMAND_METHODS[op])(*args)
+
+
+def command_table(L):
+    # command -> bound method of L, for looking operations up once per run
+    return {op: getattr(L, name) for op, name in COMMAND_METHODS.items()}
+
+
+def json_lines_hook(f):
+    # an LFS hook writing every event to f as a line of JSON
+    def hook(event, seconds, fields):
+        record = {"event": event, "seconds": seconds}
+        record.update(fields)
+        f.write(json.dumps(record) + "\n")
+
+    return hook
+
+
+def parse_command(command):
+    # "w,/path,offset,num_blks" -> ("w", ("/path", offset, num_blks))
+    command_and_args = command.split(",")
+    if command_and_args[0] == "w":
+        return "w", (
+            command_and_args[1],
+            int(command_and_args[2]),
+            int(command_and_args[3]),
+        )
+    return command_and_args[0], tuple(command_and_args[1:])
+
+
+def read_trace(source):
+    # parsed commands, one at a time, from a trace file (text with one
+    # command per line, or binary) or from any iterable of command strings
+    if not isinstance(source, str):
+        for command in source:
+            if isinstance(command, str):
+                command = parse_command(command)
+            yield command
+        return
+    with open(source, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            f.seek(0)
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield parse_command(line.decode())
+            return
+        paths = []
+        while True:
+            record = f.read(TRACE_RECORD.size)
+            if len(record) < TRACE_RECORD.size:
+                return
+            code, path_number = TRACE_RECORD.unpack(record)
+            if code & TRACE_NEW_PATH:
+                code &= ~TRACE_NEW_PATH
+                (path_length,) = TRACE_PATH_LENGTH.unpack(
+                    f.read(TRACE_PATH_LENGTH.size)
+                )
+                paths.append(f.read(path_length).decode())
+            path = paths[path_number]
+            if code == TRACE_CODES["w"]:
+                offset, num_blks = TRACE_WRITE_ARGS.unpack(
+                    f.read(TRACE_WRITE_ARGS.size)
+                )
+                yield "w", (path, offset, num_blks)
+            else:
+                yield TRACE_COMMANDS.get(code, "?"), (path,)
+
+
+def write_trace(path, commands, binary=True):
+    # save commands (strings, or from read_trace()) as a trace file
+    paths = {}
+    with open(path, "wb") as f:
+        if binary:
+            f.write(TRACE_MAGIC)
+        for command in commands:
+            if isinstance(command, str):
+                command = parse_command(command)
+            op, args = command
+            if not binary:
+                f.write((",".join([op] + [str(arg) for arg in args]) + "\n").encode())
+                continue
+            code = TRACE_CODES[op]
+            path_number = paths.get(args[0])
+            if path_number is None:
+                path_number = paths[args[0]] = len(paths)
+                encoded_path = args[0].encode()
+                f.write(TRACE_RECORD.pack(code | TRACE_NEW_PATH, path_number))
+                f.write(TRACE_PATH_LENGTH.pack(len(encoded_path)))
+                f.write(encoded_path)
+            else:
+                f.write(TRACE_RECORD.pack(code, path_number))
+            if op == "w":
+                f.write(TRACE_WRITE_ARGS.pack(args[1], args[2]))
+    return
+
+
+def replay(L, source, quiet=True):
+    # run a trace (see read_trace()) through L as it streams in: operations
+    # are looked up once, and quiet drops all output, so only counts are kept
+    operations = command_table(L)
+    stats = {"ops": 0, "failures": 0, "skipped": 0}
+    blocks_written = L.blocks_written
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if quiet:
+            stack.enter_context(
+                contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w")))
+            )
+        for op, args in read_trace(source):
+            operation = operations.get(op)
+            if operation is None:
+                stats["skipped"] += 1
+                continue
+            if operation(*args) == -1:
+                stats["failures"] += 1
+            stats["ops"] += 1
+    stats["seconds"] = time.perf_counter() - start
+    stats["blocks_written"] = L.blocks_written - blocks_written
+    return stats
+
+
+def parse_and_execute(commands, write_buffer_size=0, clean_policy=CLEAN_COST_BENEFIT):
+    L = LFS(write_buffer_size=write_buffer_size, clean_policy=clean_policy)
     print()
     print("INITIAL file system contents:")
     L.dump()
-    L.dump_last = 4
     print()
 
-    disk_len = len(L.disk)
+    blocks_written = L.blocks_written
     block_usage = []
+    latencies = []
+    operations = command_table(L)
     for i in range(len(commands)):
-        command_and_args = commands[i].split(",")
-        if command_and_args[0] == "c":
-            print("create file", command_and_args[1])
-            L.file_create(command_and_args[1])
-        elif command_and_args[0] == "d":
-            print("create dir ", command_and_args[1])
-            L.dir_create(command_and_args[1])
-        elif command_and_args[0] == "r":
-            print("delete file", command_and_args[1])
-            L.file_delete(command_and_args[1])
-        elif command_and_args[0] == "w":
-            print(
-                "write file  %s offset=%d size=%d"
-                % (
-                    command_and_args[1],
-                    int(command_and_args[2]),
-                    int(command_and_args[3]),
-                ),
-            )
-            L.file_write(
-                command_and_args[1], int(command_and_args[2]), int(command_and_args[3])
-            )
+        op, args = parse_command(commands[i])
+        if op == "c":
+            print("create file", *args)
+        elif op == "d":
+            print("create dir ", *args)
+        elif op == "r":
+            print("delete file", *args)
+        elif op == "w":
+            print("write file  %s offset=%d size=%d" % args)
         else:
-            print("command not understood so skipping [%s]" % command_and_args[0])
+            print("command not understood so skipping [%s]" % op)
+        start = time.perf_counter()
+        if op in operations:
+            operations[op](*args)
+        latencies.append(time.perf_counter() - start)
 
         L.dump_partial(False, False)
         print()
-        block_usage.append(len(L.disk) - disk_len)
-        disk_len = len(L.disk)
+        block_usage.append(L.blocks_written - blocks_written)
+        blocks_written = L.blocks_written
+
+    # push out whatever is still sitting in the write buffer
+    block_usage.append(L.flush())
 
     print("FINAL file system contents:")
     L.dump()
@@ -754,16 +3262,656 @@ def parse_and_execute(commands):
     print(
         "Average block addition per file operation:", sum(block_usage) / len(commands)
     )
+    print("Garbage collections:", L.gc_count)
+    print("Checkpoints:", L.checkpoint_timestamp)
+    print("Dentry cache hits/misses: %d/%d" % (L.dentry_hits, L.dentry_misses))
+    for name, cache in (("Inode", L.inode_cache), ("Imap", L.imap_cache)):
+        if cache.size:
+            print(
+                "%s cache hit rate: %.2f (%d evictions)"
+                % (name, cache.hit_rate(), cache.evictions)
+            )
+    print("Cleaning cost (blocks read and written per block freed):", L.clean_cost())
+    print("Segment utilization (0-10% .. 90-100%):", L.segment_utilization())
+    print(
+        "Operation latency p50/p99/max (ms): %.3f/%.3f/%.3f"
+        % tuple(1000 * latency for latency in latency_percentiles(latencies))
+    )
     # L.gc()
     # print("After GC:")
     # L.dump()
     # print(f"Disk usage reduced from {disk_len} to {len(L.disk)}")
 
 
-def benchmark():
-    percents = {"c": (0.0, 0.3), "w": (0.3, 0.7), "d": (0.7, 0.9), "r": (0.9, 1.0)}
-    commands = make_commands(60, percents)
-    parse_and_execute(commands)
+def latency_percentiles(latencies):
+    # p50, p99 and max (nearest rank)
+    ordered = sorted(latencies)
+    last = len(ordered) - 1
+    return ordered[int(0.5 * last)], ordered[int(0.99 * last)], ordered[last]
+
+
+def benchmark(write_buffer_size=0, clean_policy=CLEAN_COST_BENEFIT):
+    commands = make_commands(60, COMMAND_MIX)
+    parse_and_execute(commands, write_buffer_size, clean_policy)
+
+
+def benchmark_latency(num_commands=8000, clean_budget=16):
+    # per-operation latency with stop-the-world compaction, blocking cleaning
+    # and incremental cleaning, on the same workload; the worst number of
+    # blocks written by a single operation (copies made by gc() and the
+    # cleaner included) is the pause without the noise
+    commands = make_commands(num_commands, COMMAND_MIX)
+    geometry = dict(
+        num_imap_ptrs_in_cr=16,
+        num_inodes_per_imap_chunk=16,
+        num_indirect_ptrs=8,
+        num_blocks=4096,
+    )
+    print(
+        "cleaner             p50 (ms)  p99 (ms)  max (ms)  max blocks/op  cleaning cost"
+    )
+    for name, L in (
+        ("gc() compaction", LFS(clean_policy=CLEAN_COMPACT, **geometry)),
+        ("blocking clean()", LFS(**geometry)),
+        ("incremental clean()", LFS(clean_budget=clean_budget, **geometry)),
+    ):
+        latencies = []
+        max_blocks = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            for command in commands:
+                blocks_written = L.blocks_written
+                start = time.perf_counter()
+                execute_command(L, command)
+                latencies.append(time.perf_counter() - start)
+                max_blocks = max(max_blocks, L.blocks_written - blocks_written)
+        p50, p99, worst = latency_percentiles(latencies)
+        print(
+            "%-19s %8.3f %9.3f %9.3f %14d %14.2f"
+            % (name, p50 * 1000, p99 * 1000, worst * 1000, max_blocks, L.clean_cost())
+        )
+
+
+def make_client_commands(num_clients, num_commands):
+    # num_commands split over clients, each working in a directory of its
+    # own, /c0, /c1, ...; create_client_dirs() makes those directories
+    workloads = []
+    for k in range(num_clients):
+        commands = make_commands(num_commands // num_clients, COMMAND_MIX)
+        workloads.append(
+            [command[:2] + "/c%d" % k + command[2:] for command in commands]
+        )
+    return workloads
+
+
+def create_client_dirs(L, num_clients):
+    for k in range(num_clients):
+        L.dir_create("/c%d" % k)
+    return
+
+
+def benchmark_group_commit(clients=(1, 2, 4, 8, 16), num_commands=4000):
+    # client threads, each in a directory of its own, going through
+    # GroupCommitLFS, against the same operations run one at a time
+    geometry = dict(
+        num_imap_ptrs_in_cr=64,
+        num_inodes_per_imap_chunk=32,
+        num_indirect_ptrs=8,
+        num_blocks=1 << 15,
+    )
+    print("clients  direct ops/s  blocks/op  group ops/s  blocks/op  ops/batch")
+    for num_clients in clients:
+        workloads = make_client_commands(num_clients, num_commands)
+
+        results = []
+        for grouped in (False, True):
+            L = LFS(**geometry)
+            with contextlib.redirect_stdout(io.StringIO()):
+                create_client_dirs(L, num_clients)
+                blocks_written = L.blocks_written
+                start = time.perf_counter()
+                if grouped:
+                    G = GroupCommitLFS(L)
+                    threads = [
+                        threading.Thread(
+                            target=lambda commands: [
+                                G.submit(command).result() for command in commands
+                            ],
+                            args=(commands,),
+                        )
+                        for commands in workloads
+                    ]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    G.close()
+                else:
+                    for commands in workloads:
+                        for command in commands:
+                            execute_command(L, command)
+                elapsed = time.perf_counter() - start
+            num_ops = sum(len(commands) for commands in workloads)
+            results.append(num_ops / elapsed)
+            results.append((L.blocks_written - blocks_written) / num_ops)
+        print(
+            "%7d %13.0f %10.2f %12.0f %10.2f %10.2f"
+            % (num_clients, *results, G.ops / G.batches)
+        )
+
+
+def benchmark_async(clients=(1, 10, 100, 1000), num_commands=8000):
+    # client coroutines, each in a directory of its own, going through AsyncLFS
+    geometry = dict(
+        num_imap_ptrs_in_cr=64,
+        num_inodes_per_imap_chunk=64,
+        num_indirect_ptrs=16,
+        num_blocks=1 << 16,
+        dir_layout=DIR_HASHED,
+    )
+
+    async def client(A, commands):
+        for command in commands:
+            await A.execute(command)
+
+    async def run(A, workloads):
+        await asyncio.gather(*[client(A, commands) for commands in workloads])
+
+    print("clients    ops/s  blocks/op  ops/commit")
+    for num_clients in clients:
+        workloads = make_client_commands(num_clients, num_commands)
+        L = LFS(**geometry)
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_client_dirs(L, num_clients)
+            blocks_written = L.blocks_written
+            A = AsyncLFS(L)
+            start = time.perf_counter()
+            asyncio.run(run(A, workloads))
+            elapsed = time.perf_counter() - start
+        print(
+            "%7d %8.0f %10.2f %11.2f"
+            % (
+                num_clients,
+                A.ops / elapsed,
+                (L.blocks_written - blocks_written) / A.ops,
+                A.ops / A.commits,
+            )
+        )
+
+
+def benchmark_read(num_files=400, num_writes=20000, file_blocks=16):
+    # how cleaning policies leave files laid out for reading: fill files,
+    # rewrite single blocks of them (90% to 10% of the files), then read
+    # every file back from start to end
+    commands = make_skewed_commands(num_files, num_writes, file_blocks=file_blocks)
+    geometry = dict(
+        num_imap_ptrs_in_cr=32,
+        num_inodes_per_imap_chunk=16,
+        num_indirect_ptrs=16,
+        num_blocks=4 * num_files * file_blocks,
+        dir_layout=DIR_HASHED,
+    )
+    print("policy                     locality  fetches/block  hit rate  cleaning cost")
+    for name, kwargs in (
+        ("gc() compaction", dict(clean_policy=CLEAN_COMPACT)),
+        ("greedy", dict(clean_policy=CLEAN_GREEDY)),
+        ("cost-benefit", dict()),
+        ("cost-benefit, hot_age=200", dict(hot_age=200)),
+    ):
+        L = LFS(read_cache_size=256, readahead=SEGMENT_SIZE - 1, **geometry, **kwargs)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for command in commands:
+                execute_command(L, command)
+            L.flush()
+        for i in range(num_files):
+            L.file_read("/f%d" % i, 0, file_blocks)
+        print(
+            "%-26s %8.1f %14.2f %9.2f %14.2f"
+            % (
+                name,
+                L.read_locality(),
+                L.read_stats["fetches"] / L.read_stats["blocks"],
+                L.read_cache.hit_rate(),
+                L.clean_cost(),
+            )
+        )
+
+
+def benchmark_replay(num_commands=20000):
+    # the same commands through parse_and_execute() (output discarded), and
+    # replayed from a generator, a text trace and a binary trace
+    commands = make_commands(num_commands, COMMAND_MIX)
+    with tempfile.TemporaryDirectory() as directory:
+        text_path = os.path.join(directory, "trace.txt")
+        binary_path = os.path.join(directory, "trace.bin")
+        write_trace(text_path, commands, binary=False)
+        write_trace(binary_path, commands)
+        print("source             ops/s  trace bytes")
+
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                parse_and_execute(commands)
+                elapsed = time.perf_counter() - start
+        print("%-15s %8.0f %12s" % ("parse_and_execute", num_commands / elapsed, "-"))
+
+        for name, source, size in (
+            ("generator", (command for command in commands), "-"),
+            ("text trace", text_path, os.path.getsize(text_path)),
+            ("binary trace", binary_path, os.path.getsize(binary_path)),
+        ):
+            stats = replay(LFS(), source)
+            print("%-15s %8.0f %12s" % (name, stats["ops"] / stats["seconds"], size))
+
+
+def benchmark_workload(num_commands=1000000):
+    # commands per second from make_commands() and generate_commands()
+    print("generator                        commands/s")
+    start = time.perf_counter()
+    make_commands(num_commands, COMMAND_MIX)
+    elapsed = time.perf_counter() - start
+    print("%-31s %11.0f" % ("make_commands()", num_commands / elapsed))
+    backend = "numpy" if numpy is not None else "random"
+    for name, kwargs in (
+        ("generate_commands()", dict()),
+        ("generate_commands(), zipf", dict(popularity=POPULARITY_ZIPF)),
+        ("generate_commands(), parsed", dict(parsed=True)),
+    ):
+        start = time.perf_counter()
+        for command in generate_commands(num_commands, COMMAND_MIX, **kwargs):
+            pass
+        elapsed = time.perf_counter() - start
+        print("%-31s %11.0f (%s)" % (name, num_commands / elapsed, backend))
+
+
+# named workloads for benchmark_suite(): seed, number of commands -> commands;
+# most new entries go in subdirectories, so the root doesn't fill up
+SUITE_WORKLOADS = {
+    "mixed": lambda seed, n: generate_commands(n, seed=seed, depths=(1, 4, 4)),
+    "zipf": lambda seed, n: generate_commands(
+        n,
+        seed=seed,
+        popularity=POPULARITY_ZIPF,
+        write_sizes=(0, 4, 2, 1),
+        depths=(1, 4, 4),
+    ),
+    "churn": lambda seed, n: generate_commands(
+        n,
+        {"c": (0.0, 0.4), "w": (0.4, 0.6), "d": (0.6, 0.65), "r": (0.65, 1.0)},
+        seed=seed,
+        depths=(1, 4, 4),
+    ),
+    "hot_cold": lambda seed, n: make_skewed_commands(
+        n // 20, n - n // 10, file_blocks=8, rng=random.Random(seed)
+    ),
+}
+
+# geometry for the suite and sweeps: room for every file and directory the
+# workloads keep around at once
+SUITE_GEOMETRY = {
+    "num_imap_ptrs_in_cr": 32,
+    "num_inodes_per_imap_chunk": 64,
+    "num_indirect_ptrs": 8,
+    "dir_layout": DIR_HASHED,
+    "checkpoint_interval": 16,
+}
+
+# metrics compare_benchmarks() checks, and whether higher is better
+SUITE_METRICS = {
+    "ops_per_sec": True,
+    "blocks_per_op": False,
+    "gc_count": False,
+    "cleaner_bytes_moved": False,
+}
+
+
+def run_benchmark(commands, **kwargs):
+    # one run of commands on a new LFS(**kwargs), timing every operation
+    L = LFS(**kwargs)
+    operations = command_table(L)
+    op_count = {}
+    op_time = {}
+    failures = 0
+    skipped = 0
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for op, args in read_trace(commands):
+                operation = operations.get(op)
+                if operation is None:
+                    skipped += 1
+                    continue
+                op_start = time.perf_counter()
+                if operation(*args) == -1:
+                    failures += 1
+                op_time[op] = op_time.get(op, 0) + time.perf_counter() - op_start
+                op_count[op] = op_count.get(op, 0) + 1
+            L.flush()
+            elapsed = time.perf_counter() - start
+    num_ops = sum(op_count.values())
+    return {
+        "ops": num_ops,
+        "failures": failures,
+        "skipped": skipped,
+        "ops_per_sec": num_ops / elapsed,
+        "seconds_per_op": {op: op_time[op] / op_count[op] for op in sorted(op_count)},
+        "blocks_per_op": L.blocks_written / num_ops,
+        "blocks_per_op_by_type": {
+            block_type: count / num_ops
+            for block_type, count in sorted(L.blocks_by_type.items())
+        },
+        "checkpoints": L.checkpoint_timestamp,
+        "gc_count": L.gc_count,
+        "clean_steps": L.clean_steps,
+        "cleaner_bytes_moved": L.clean_stats["moved"] * IMAGE_BLOCK_SIZE,
+        "clean_cost": L.clean_cost(),
+    }
+
+
+def benchmark_suite(
+    output=None,
+    baseline=None,
+    workloads=tuple(SUITE_WORKLOADS),
+    disk_sizes=(6144, 8192, 16384),
+    gc_thresholds=(0.7, 0.8, 0.9),
+    checkpoint_policies=(CHECKPOINT_EVERY_OP, CHECKPOINT_OPS),
+    num_commands=2000,
+    seed=0,
+    repeat=3,
+):
+    # every workload on every disk size, gc threshold and checkpoint policy,
+    # keeping the fastest of repeat runs (everything else is the same each
+    # time); results go to output as JSON, and are checked against a baseline
+    results = []
+    print(
+        "workload  blocks  gc_threshold  checkpoint   ops/s  blocks/op  gcs  moved (KiB)  failures"
+    )
+    for workload in workloads:
+        commands = list(SUITE_WORKLOADS[workload](seed, num_commands))
+        for num_blocks in disk_sizes:
+            for gc_threshold in gc_thresholds:
+                for checkpoint_policy in checkpoint_policies:
+                    config = {
+                        "workload": workload,
+                        "num_blocks": num_blocks,
+                        "gc_threshold": gc_threshold,
+                        "checkpoint_policy": checkpoint_policy,
+                    }
+                    result = None
+                    for i in range(repeat):
+                        # same block contents on every run
+                        run = run_benchmark(
+                            commands,
+                            rng=random.Random(seed),
+                            num_blocks=num_blocks,
+                            gc_threshold=gc_threshold,
+                            checkpoint_policy=checkpoint_policy,
+                            **SUITE_GEOMETRY,
+                        )
+                        if result is None or run["ops_per_sec"] > result["ops_per_sec"]:
+                            result = run
+                    results.append({"config": config, "result": result})
+                    print(
+                        "%-8s %7d %13.2f %11d %7.0f %10.2f %4d %12d %9d"
+                        % (
+                            workload,
+                            num_blocks,
+                            gc_threshold,
+                            checkpoint_policy,
+                            result["ops_per_sec"],
+                            result["blocks_per_op"],
+                            result["gc_count"],
+                            result["cleaner_bytes_moved"] // 1024,
+                            result["failures"],
+                        )
+                    )
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump({"seed": seed, "results": results}, f, indent=1)
+    if baseline is not None:
+        with open(baseline) as f:
+            compare_benchmarks(json.load(f)["results"], results)
+    return results
+
+
+def compare_benchmarks(baseline, results, tolerance=0.05, time_tolerance=0.25):
+    # regressions of results against baseline (both lists of config/result
+    # pairs, as saved by benchmark_suite()); timings get a looser tolerance
+    expected = {tuple(sorted(run["config"].items())): run["result"] for run in baseline}
+    regressions = []
+    for run in results:
+        old = expected.get(tuple(sorted(run["config"].items())))
+        if old is None:
+            continue
+        for metric, higher_is_better in SUITE_METRICS.items():
+            limit = time_tolerance if metric == "ops_per_sec" else tolerance
+            before, after = old[metric], run["result"][metric]
+            if higher_is_better:
+                worse = after < before * (1 - limit)
+            else:
+                worse = after > before * (1 + limit) and after - before > 1e-9
+            if worse:
+                regressions.append((run["config"], metric, before, after))
+    for config, metric, before, after in regressions:
+        print(
+            "REGRESSION %s: %s %s -> %s"
+            % (
+                " ".join("%s=%s" % item for item in sorted(config.items())),
+                metric,
+                before,
+                after,
+            )
+        )
+    print("%d regressions in %d runs" % (len(regressions), len(results)))
+    return regressions
+
+
+def run_sweep_point(workload, seed, config, num_commands):
+    # one sweep run, with random numbers of its own for both the commands
+    # and block contents, so it comes out the same in any process; config
+    # goes on top of the suite's geometry
+    commands = SUITE_WORKLOADS[workload](seed, num_commands)
+    kwargs = dict(SUITE_GEOMETRY)
+    kwargs.update(config)
+    return run_benchmark(commands, rng=random.Random(seed), **kwargs)
+
+
+def sweep(
+    grid,
+    workloads=("mixed",),
+    seeds=(0, 1, 2),
+    num_commands=2000,
+    max_workers=None,
+):
+    # every combination of the LFS keyword arguments in grid (name -> list of
+    # values), workload and seed, run in a pool of processes (max_workers=1
+    # runs them here instead); prints the averages over seeds per
+    # configuration, and returns them
+    names = sorted(grid)
+    configs = [
+        dict(zip(names, values))
+        for values in itertools.product(*[grid[name] for name in names])
+    ]
+    points = [
+        (workload, seed, config)
+        for workload in workloads
+        for config in configs
+        for seed in seeds
+    ]
+    if max_workers == 1:
+        results = [
+            run_sweep_point(workload, seed, config, num_commands)
+            for workload, seed, config in points
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers) as executor:
+            futures = [
+                executor.submit(run_sweep_point, workload, seed, config, num_commands)
+                for workload, seed, config in points
+            ]
+            results = [future.result() for future in futures]
+
+    # average over seeds
+    rows = []
+    for i in range(0, len(points), len(seeds)):
+        workload, seed, config = points[i]
+        runs = results[i : i + len(seeds)]
+        row = {"workload": workload}
+        row.update(config)
+        for metric in (
+            "ops_per_sec",
+            "blocks_per_op",
+            "gc_count",
+            "clean_cost",
+            "failures",
+        ):
+            row[metric] = sum(run[metric] for run in runs) / len(runs)
+        rows.append(row)
+
+    columns = ["workload"] + names
+    print(
+        " ".join("%14s" % column for column in columns)
+        + "     ops/s  blocks/op  gcs  clean cost  failures"
+    )
+    for row in rows:
+        print(
+            " ".join("%14s" % row[column] for column in columns)
+            + " %9.0f %10.2f %4.1f %11.2f %9.1f"
+            % (
+                row["ops_per_sec"],
+                row["blocks_per_op"],
+                row["gc_count"],
+                row["clean_cost"],
+                row["failures"],
+            )
+        )
+    return rows
+
+
+def benchmark_hot_cold(hot_ages=(0, 32, 200), num_files=400, num_writes=20000):
+    # cleaning cost on a skewed workload, with and without hot/cold streams;
+    # big enough that one directory holds all files and segments are plenty
+    commands = make_skewed_commands(num_files, num_writes)
+    print(
+        "hot_age  cleaning cost  blocks written  segment utilization (0-10% .. 90-100%)"
+    )
+    for hot_age in hot_ages:
+        L = LFS(
+            hot_age=hot_age,
+            num_blocks=3000,
+            num_indirect_ptrs=128,
+            num_imap_ptrs_in_cr=16,
+            num_inodes_per_imap_chunk=32,
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            for command in commands:
+                execute_command(L, command)
+        print(
+            "%7d %14.2f %15d  %s"
+            % (hot_age, L.clean_cost(), L.blocks_written, L.segment_utilization())
+        )
+
+
+def benchmark_dedup(num_files=100, file_blocks=8, backups=12, keep=4, change=0.1):
+    # backup-style workload: every backup copies all files into a directory
+    # of its own, with `change` of the files having had a block changed since
+    # the last one, and only the latest `keep` backups are kept
+    rng = random.Random(0)
+    data = [["%d.%d.0" % (i, j) for j in range(file_blocks)] for i in range(num_files)]
+    print(
+        "dedup  blocks written  data blocks  cleanings  cleaning cost  live blocks  ratio  index (KB)  time (s)"
+    )
+    for dedup in (False, True):
+        L = LFS(
+            dedup=dedup,
+            num_imap_ptrs_in_cr=32,
+            num_inodes_per_imap_chunk=32,
+            num_indirect_ptrs=16,
+            num_blocks=8192,
+            dir_layout=DIR_HASHED,
+        )
+        files = [list(blocks) for blocks in data]
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for k in range(backups):
+                for i in range(num_files):
+                    if k and rng.random() < change:
+                        j = rng.randrange(file_blocks)
+                        files[i][j] = "%d.%d.%d" % (i, j, k)
+                L.dir_create("/b%d" % k)
+                for i in range(num_files):
+                    path = "/b%d/f%d" % (k, i)
+                    L.file_create(path)
+                    L.file_write(path, 0, file_blocks, contents=files[i])
+                if k >= keep:
+                    for i in range(num_files):
+                        L.file_delete("/b%d/f%d" % (k - keep, i))
+        elapsed = time.perf_counter() - start
+        print(
+            "%5s %15d %12d %10d %14.2f %12d %6.2f %11.1f %9.2f"
+            % (
+                dedup,
+                L.blocks_written,
+                L.blocks_by_type.get(BLOCK_TYPE_DATA_BLOCK, 0),
+                L.gc_count + L.clean_steps,
+                L.clean_cost(),
+                sum(L.live),
+                L.dedup_ratio(),
+                L.dedup_index_size() / 1024,
+                elapsed,
+            )
+        )
+
+
+def benchmark_mount(path, lengths=(100, 400, 1600), intervals=(1, 16, 256)):
+    # mount time against log length and checkpoint interval: run a workload on
+    # an image, checkpointing every `interval` operations, then mount it again;
+    # the disk is big enough that cleaning never takes checkpoints of its own.
+    # the mounted file system then writes the files again without checkpoints
+    # and is mounted once more, which has to find the same inode map
+    geometry = dict(
+        num_imap_ptrs_in_cr=32,
+        num_inodes_per_imap_chunk=32,
+        num_indirect_ptrs=16,
+        num_blocks=1 << 15,
+    )
+    print("commands interval  blocks  rolled forward  mount time (ms)")
+    for num_commands in lengths:
+        commands = make_commands(num_commands, COMMAND_MIX)
+        for interval in intervals:
+            if os.path.exists(path):
+                os.remove(path)
+            L = LFS(no_force_checkpoints=True, disk=MmapDisk(path), **geometry)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(len(commands)):
+                    execute_command(L, commands[i])
+                    if (i + 1) % interval == 0:
+                        L.cr_sync()
+            L.disk.close()
+
+            start = time.perf_counter()
+            M = LFS(
+                no_force_checkpoints=True, disk=MmapDisk(path), mount=True, **geometry
+            )
+            elapsed = time.perf_counter() - start
+            blocks = len(M.disk)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for command in commands:
+                    if command.startswith("w,"):
+                        execute_command(M, command)
+            M.disk.close()
+            R = LFS(disk=MmapDisk(path), mount=True, **geometry)
+            assert R.inode_map == M.inode_map
+            R.disk.close()
+            print(
+                "%8d %8d %7d %15d %16.2f"
+                % (
+                    num_commands,
+                    interval,
+                    blocks,
+                    M.rolled_forward,
+                    elapsed * 1000,
+                )
+            )
 
 
 if __name__ == "__main__":